@@ -1,12 +1,17 @@
 # app/core/config.py
 from __future__ import annotations
 
+from functools import cached_property, lru_cache
 from typing import Optional, List
 from pydantic_settings import BaseSettings
 from pydantic import Field, field_validator
 import json
 import re
 
+_DUR_RE = re.compile(r"(\d+)\s*([smh])")
+_NUM_RE = re.compile(r"\d+")
+_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600}
+
 
 def _parse_duration_to_seconds(v, default_sec: int) -> int:
     if v is None:
@@ -18,16 +23,11 @@ def _parse_duration_to_seconds(v, default_sec: int) -> int:
         return default_sec
     if s.isdigit():
         return int(s)
-    m = re.fullmatch(r"(\d+)\s*([smh])", s)
+    m = _DUR_RE.fullmatch(s)
     if not m:
-        m2 = re.search(r"\d+", s)
+        m2 = _NUM_RE.search(s)
         return int(m2.group()) if m2 else default_sec
-    num, unit = int(m.group(1)), m.group(2)
-    if unit == "s":
-        return num
-    if unit == "m":
-        return num * 60
-    return num * 3600
+    return int(m.group(1)) * _UNIT_SECONDS[m.group(2)]
 
 
 class Settings(BaseSettings):
@@ -46,6 +46,15 @@ class Settings(BaseSettings):
     db_trust_server_cert: str = Field("yes", alias="DB_TRUST_SERVER_CERT")
     db_connect_timeout: int = Field(15, alias="DB_CONNECT_TIMEOUT")
     db_skip_startup_check: bool = Field(True, alias="DB_SKIP_STARTUP_CHECK")
+    # read INFORMATION_SCHEMA at startup (in the background; failures are only logged)
+    warm_schema_on_startup: bool = Field(True, alias="WARM_SCHEMA_ON_STARTUP")
+
+    # Connection pool
+    db_pool_size: int = Field(10, alias="DB_POOL_SIZE")
+    db_max_overflow: int = Field(10, alias="DB_MAX_OVERFLOW")
+    db_pool_timeout: int = Field(30, alias="DB_POOL_TIMEOUT")
+    db_pool_recycle: int = Field(1800, alias="DB_POOL_RECYCLE")
+    db_pool_pre_ping: bool = Field(False, alias="DB_POOL_PRE_PING")
 
     # LLM / Ollama
     ollama_model: str = Field("qwen2.5-coder:latest", alias="OLLAMA_MODEL")
@@ -57,7 +66,13 @@ class Settings(BaseSettings):
 
     # API
     cors_origins: str = Field("*", alias="CORS_ORIGINS")
+    log_level: str = Field("INFO", alias="LOG_LEVEL")
     preview_limit: int = Field(200, alias="PREVIEW_LIMIT")
+    export_max_rows: int = Field(100_000, alias="EXPORT_MAX_ROWS")
+
+    # result cache for /presets/run and /pattern (0 disables)
+    preset_cache_ttl: int = Field(60, alias="PRESET_CACHE_TTL")
+    preset_cache_size: int = Field(128, alias="PRESET_CACHE_SIZE")
 
     class Config:
         env_file = ".env"
@@ -73,7 +88,7 @@ class Settings(BaseSettings):
     def _v_keepalive(cls, v):
         return _parse_duration_to_seconds(v, 900)
 
-    @property
+    @cached_property
     def cors_origins_list(self) -> List[str]:
         raw = (self.cors_origins or "").strip()
         if not raw or raw == "*":
@@ -84,7 +99,16 @@ class Settings(BaseSettings):
                 return [s.strip() for s in arr if isinstance(s, str)]
             except Exception:
                 pass
-        return [o.strip() for o in raw.split(",") if o.strip()]
+        return [o.strip() for o in raw.split(",") if o.strip()] or ["*"]
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Return the process-wide Settings instance (parsed from env/.env once).
+    Use with FastAPI `Depends(get_settings)` so tests can override it.
+    """
+    return Settings()
 
 
-settings = Settings()
+settings = get_settings()
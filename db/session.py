@@ -1,12 +1,18 @@
 # app/db/session.py
+import logging
+from decimal import Decimal
 from functools import lru_cache
 import urllib.parse
+from typing import Any, Dict, List, Tuple
 
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
+from sqlalchemy.sql.elements import TextClause
 
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
 
 def _build_pyodbc_url_from_env() -> str:
     """
@@ -46,16 +52,24 @@ def get_engine() -> Engine:
     Return the single SQLAlchemy engine used across the app.
     All code must call get_engine() and NOT import a global `engine`.
     """
-    if settings.database_url:
-        uri = settings.database_url.strip().strip('"').strip("'")
-    else:
-        uri = _build_pyodbc_url_from_env()
+    # built on first DB use (once, as the engine is cached) so bad DB settings
+    # do not stop the app from importing
+    uri = (settings.database_url or _build_pyodbc_url_from_env()).strip().strip('"').strip("'")
+    kwargs = {}
+    if uri.startswith("mssql+pyodbc"):
+        kwargs["fast_executemany"] = True
 
+    # no pre-ping by default: pool_recycle + the ODBC connection timeout
+    # cover stale connections without a SELECT 1 on every checkout
     engine = create_engine(
         uri,
-        pool_pre_ping=True,
-        pool_recycle=180,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
         future=True,
+        **kwargs,
     )
     return engine
 
@@ -69,7 +83,35 @@ def verify_connection(raise_on_error: bool = False) -> bool:
             conn.execute(text("SELECT 1"))
         return True
     except Exception as e:
-        print(f"[DB] verify_connection failed: {e}")
+        logger.warning("verify_connection failed: %s", e)
         if raise_on_error:
             raise
         return False
+
+
+def json_value(v: Any) -> Any:
+    # SQL Server DECIMAL/MONEY come back as Decimal; keep returning numbers
+    return float(v) if isinstance(v, Decimal) else v
+
+
+@lru_cache(maxsize=512)
+def sql_text(sql: str) -> TextClause:
+    """
+    text(sql), built once per distinct statement (TextClause is immutable, so it can be shared).
+    """
+    return text(sql)
+
+
+def fetch_rows(sql: str, limit: int) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    Execute a checked SELECT and fetch at most `limit` rows straight from the cursor.
+    """
+    with get_engine().connect() as conn:
+        # stream so the driver never buffers more than we fetch
+        res = conn.execution_options(stream_results=True).execute(sql_text(sql))
+        cols = list(res.keys())
+        rows = [
+            {c: json_value(v) for c, v in zip(cols, r)}
+            for r in res.fetchmany(limit)
+        ]
+    return cols, rows
@@ -1,17 +1,28 @@
+import logging
+import threading
 from pathlib import Path
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 
-from app.core.config import settings
+from app.core.config import get_settings
+from app.db.session import verify_connection
 from app.routers.query import router as query_router
+from app.services.ollama_client import aclose_async_client
+from app.services.schema_cache import load_schema
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=get_settings().log_level.upper(),
+    format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+)
 
 app = FastAPI(title="PharmacyDB LLM API", version="1.0.0")
 
-origins = [o.strip() for o in (settings.cors_origins or "").split(",") if o.strip()] or ["*"]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
+    allow_origins=get_settings().cors_origins_list,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -19,10 +30,37 @@ app.add_middleware(
 
 app.include_router(query_router)
 
-_frontend = Path(__file__).parent / "frontend"
-if _frontend.exists():
-    app.mount("/app", StaticFiles(directory=str(_frontend), html=True), name="frontend")
+
+def _warm_schema():
+    try:
+        load_schema()
+    except Exception as e:
+        logger.warning("schema warm-up failed (non-fatal): %s", e)
+
+
+@app.on_event("startup")
+def _startup_db_check():
+    # the engine is created lazily; only probe the DB here when asked to
+    if not get_settings().db_skip_startup_check:
+        verify_connection()
+    # read INFORMATION_SCHEMA now rather than on the first agents/langchain request;
+    # in a thread so an unreachable DB does not hold up startup
+    if get_settings().warm_schema_on_startup:
+        threading.Thread(target=_warm_schema, name="schema-warmup", daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def _shutdown_llm_client():
+    await aclose_async_client()
+
+
+FRONTEND_DIR = Path(__file__).parent / "frontend"
+# stat once at startup; nothing on the request path touches the filesystem
+_HAS_FRONTEND = FRONTEND_DIR.exists()
+if _HAS_FRONTEND:
+    app.mount("/app", StaticFiles(directory=str(FRONTEND_DIR), html=True), name="frontend")
 
 @app.get("/")
 def root():
+    settings = get_settings()
     return {"name": "PharmacyDB LLM API", "db": settings.db_name, "model": settings.ollama_model, "status": "ok"}
@@ -1,3 +1,9 @@
+# Indexes these presets benefit from (create on the DB side, not from the app):
+#   selling(ProductCode, Date) INCLUDE (QuantitySold, SellingPrice, ManufacturerCost)
+#   selling(Store) INCLUDE (QuantitySold, SellingPrice)
+#   buying(ProductCode) INCLUDE (NetQuantity, QuantityBuying, NetCost, CostBuying)
+#   products(Quantity) INCLUDE (ProductName, Classification)  -- or filtered: WHERE Quantity <= 5
+
 IMPORTANT_QUERIES = {
     "الإيرادات الشهرية الإجمالية": """
     SELECT
@@ -70,11 +76,11 @@ IMPORTANT_QUERIES = {
     "المنتجات ذات النشاط الشهري المستمر (>= 6 أشهر مختلفة)": """
     SELECT
       [p].[ProductCode],[p].[ProductName],
-      COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) AS [MonthsWithSales]
+      COUNT(DISTINCT YEAR([s].[Date])*12 + MONTH([s].[Date])) AS [MonthsWithSales]
     FROM [dbo].[selling] AS [s]
     JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode]
     GROUP BY [p].[ProductCode],[p].[ProductName]
-    HAVING COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) >= 6
+    HAVING COUNT(DISTINCT YEAR([s].[Date])*12 + MONTH([s].[Date])) >= 6
     ORDER BY [MonthsWithSales] DESC;
     """
 }
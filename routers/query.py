@@ -1,39 +1,70 @@
 # app/routers/query.py
+import asyncio
+import logging
 import re
 import time
-import pandas as pd
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+
 from fastapi import APIRouter, HTTPException, Query
-from sqlalchemy import text
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from app.core.config import settings
-from app.db.session import get_engine
+from app.core.config import get_settings
+from app.db.session import fetch_rows, get_engine, json_value, sql_text, verify_connection
 from app.schemas.requests import QuestionRequest, SQLRunRequest
 from app.schemas.responses import QueryResponse, PresetsList, PresetRunResponse
 from app.utils.sql_safety import enforce_select_only
-from app.services.pattern import PatternSQLGenerator
-from app.services.langchain_sql import generate_and_execute
+from app.utils.ttl_cache import TTLCache
+from app.services.pattern_matcher import pattern_generator
+from app.services.langchain_sql import agenerate_and_execute
 from app.services.agents import get_agents
 from app.presets import IMPORTANT_QUERIES
 from app.services.ollama_client import generate_with_metrics
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/api", tags=["query"])
 
+_SELECT_HEAD = re.compile(r"^\s*SELECT(\s+(?:DISTINCT|ALL))?\s+(?!TOP\b)", re.IGNORECASE)
+
+# TOP N always sits right after SELECT [DISTINCT|ALL], so only the head is scanned
+_TOP_SCAN_WINDOW = 64
+_TOP_N = re.compile(r"\bTOP\s+([0-9]+)", re.IGNORECASE)
+# a head TOP would only limit the first branch of a set operator, and SQL Server
+# rejects TOP in the same query as OFFSET/FETCH
+_NO_TOP_INJECT = re.compile(r"\b(?:UNION|INTERSECT|EXCEPT|OFFSET)\b", re.IGNORECASE)
+
 
 def _extract_requested_top(sql: str) -> int | None:
     """
     Try to detect a TOP N in the T-SQL statement.
     Returns N or None.
     """
-    m = re.search(r"\bTOP\s+(\d+)\b", sql, flags=re.IGNORECASE)
-    if not m:
-        return None
-    try:
-        return int(m.group(1))
-    except ValueError:
-        return None
+    head = sql[:_TOP_SCAN_WINDOW]
+    if not head.isascii():
+        # upper() can change the length of non-ASCII text ("ß" -> "SS"), so offsets
+        # into it would not line up with sql
+        m = _TOP_N.search(sql)
+        return int(m.group(1)) if m and m.start() < _TOP_SCAN_WINDOW else None
+    head = head.upper()
+    i = head.find("TOP")
+    while i >= 0:
+        j = i + 3
+        if (i == 0 or not (head[i - 1].isalnum() or head[i - 1] == "_")) and j < len(head) and head[j].isspace():
+            while j < len(head) and head[j].isspace():
+                j += 1
+            k = j
+            while k < len(sql) and "0" <= sql[k] <= "9":
+                k += 1
+            if k > j:
+                return int(sql[j:k])
+        i = head.find("TOP", i + 3)
+    return None
 
 
-def _trim_df_by_sql(df: pd.DataFrame, sql: str) -> pd.DataFrame:
+def _row_limit(sql: str) -> int:
     """
     If user explicitly asked for TOP N, keep N rows (but never negative).
     Otherwise use settings.preview_limit.
@@ -41,41 +72,148 @@ def _trim_df_by_sql(df: pd.DataFrame, sql: str) -> pd.DataFrame:
     asked = _extract_requested_top(sql)
     if asked is not None:
         # allow up to the user's asked number, but do not explode to huge numbers
-        hard_cap = getattr(settings, "max_return_rows", 500)
-        limit = min(asked, hard_cap)
-        if len(df) > limit:
-            return df.head(limit)
-        return df
+        hard_cap = getattr(get_settings(), "max_return_rows", 500)
+        return max(0, min(asked, hard_cap))
     # default behavior
-    if len(df) > settings.preview_limit:
-        return df.head(settings.preview_limit)
-    return df
+    return get_settings().preview_limit
 
 
-@router.get("/health")
-def health():
+def _inject_top(sql: str, limit: int) -> str:
+    """
+    Push the row limit into the statement (SELECT TOP n) so SQL Server stops early.
+    Statements that already carry a TOP, combine SELECTs with a set operator or
+    page with OFFSET/FETCH are left as they are; fetch_rows still stops after `limit` rows.
+    """
+    if _extract_requested_top(sql) is not None or _NO_TOP_INJECT.search(sql):
+        return sql
+    return _SELECT_HEAD.sub(lambda m: f"SELECT{m.group(1) or ''} TOP {limit} ", sql, count=1)
+
+
+_RESULT_CACHE = TTLCache(
+    maxsize=get_settings().preset_cache_size,
+    ttl=get_settings().preset_cache_ttl,
+)
+
+
+def _open_stream(safe: str):
+    """
+    Start a streamed SELECT for /export. The caller owns (and must close) the connection.
+    """
+    conn = get_engine().connect()
+    try:
+        res = conn.execution_options(stream_results=True, yield_per=1000).execute(sql_text(safe))
+    except Exception:
+        conn.close()
+        raise
+    return conn, res
+
+
+def _iter_ndjson(conn, res, max_rows: int) -> Iterator[bytes]:
     try:
-        with get_engine().connect() as conn:
-            conn.execute(text("SELECT 1"))
-        db_ok = True
+        for i, m in enumerate(res.mappings()):
+            if i >= max_rows:
+                break
+            yield orjson.dumps({k: json_value(v) for k, v in m.items()}) + b"\n"
     except Exception as e:
-        print(f"[health] DB error: {e}")
-        db_ok = False
+        logger.warning("export: stream aborted: %s", e)
+        # the status line is already sent: end with an error line so a cut-short
+        # export cannot pass for a complete one
+        yield orjson.dumps({"error": f"Export aborted: {e}"}) + b"\n"
+    finally:
+        res.close()
+        conn.close()
+
+
+def _run_select_cached(safe: str, limit: int) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    fetch_rows for static SQL (presets / patterns): reuse results for a short TTL.
+    """
+    key = (safe, limit)
+    hit = _RESULT_CACHE.get(key)
+    if hit is not None:
+        return hit
+    out = fetch_rows(safe, limit)
+    _RESULT_CACHE.set(key, out)
+    return out
+
+
+def _summary(cols: List[str], n_rows: int) -> str:
+    return f"Rows: {n_rows} | columns: {', '.join(cols[:6])}" + ("..." if len(cols) > 6 else "")
+
+
+def _build_response(route: str, safe: str, cols: List[str], rows: List[Dict[str, Any]], t0: float) -> Dict[str, Any]:
+    """
+    QueryResponse-shaped dict for the direct-SQL routes (no LLM involved).
+    """
+    return {
+        "route": route,
+        "sql": safe,
+        "columns": cols,
+        "rows": rows,
+        "summary_ar": _summary(cols, len(rows)),
+        "plan": None,
+        "model": None,
+        "llm_prompt_tokens": 0,
+        "llm_eval_tokens": 0,
+        "llm_total_tokens": 0,
+        "llm_duration_ms": 0,
+        "total_ms": int((time.perf_counter() - t0) * 1000),
+    }
+
+
+def _prepare_preset(sql: str) -> Tuple[str, str, int]:
+    safe = enforce_select_only(sql)
+    limit = _row_limit(safe)
+    return safe, _inject_top(safe, limit), limit
+
 
-    out = generate_with_metrics("ping", num_predict=1, timeout_seconds=4.0)
+# presets are static: strip / check / inject TOP once at import
+_PRESET_TEXTS: Dict[str, str] = {
+    k: v.strip() if isinstance(v, str) else str(v) for k, v in IMPORTANT_QUERIES.items()
+}
+_PRESETS_PREPARED: Dict[str, Tuple[str, str, int]] = {
+    k: _prepare_preset(v) for k, v in _PRESET_TEXTS.items()
+}
+
+
+# dashboards poll /health every few seconds; reuse probe results briefly
+_HEALTH_CACHE = TTLCache(maxsize=2, ttl=2.0)
+
+
+async def _cached_probe(key: str, fn, *args, **kwargs):
+    hit = _HEALTH_CACHE.get(key)
+    if hit is not None:
+        return hit
+    out = await run_in_threadpool(fn, *args, **kwargs)
+    _HEALTH_CACHE.set(key, out)
+    return out
+
+
+@router.get("/health")
+async def health():
+    # DB and LLM probes are independent: wait on both at once
+    db_ok, out = await asyncio.gather(
+        _cached_probe("db", verify_connection),
+        _cached_probe("llm", generate_with_metrics, "ping", num_predict=1, timeout_seconds=4.0),
+        return_exceptions=True,
+    )
+    if isinstance(db_ok, BaseException):
+        db_ok = False
+    if isinstance(out, BaseException):
+        out = {"text": "", "error": str(out)}
     llm_ok = not out.get("error")
 
     return {
         "status": "ok" if db_ok else "db-failed",
-        "db": settings.db_name,
+        "db": get_settings().db_name,
         "llm_ok": llm_ok,
         "llm_error": out.get("error"),
     }
 
 
 @router.get("/llm/warmup")
-def llm_warmup():
-    out = generate_with_metrics("ping", num_predict=1, timeout_seconds=6.0)
+async def llm_warmup():
+    out = await run_in_threadpool(generate_with_metrics, "ping", num_predict=1, timeout_seconds=6.0)
     if out.get("error"):
         raise HTTPException(500, f"LLM warmup failed: {out['error']}")
     return {
@@ -88,127 +226,104 @@ def llm_warmup():
 
 
 @router.post("/pattern", response_model=QueryResponse)
-def pattern_route(req: QuestionRequest):
+async def pattern_route(req: QuestionRequest):
     """
     1) Try pattern-based SQL.
     2) If no pattern, fall back to langchain route.
     """
     t0 = time.perf_counter()
-    sql = PatternSQLGenerator.generate(req.question)
+    sql = pattern_generator().generate(req.question)
 
     # no pattern -> fallback to LLM route
     if not sql:
-        print("[pattern] no pattern matched, falling back to langchain...")
-        result = generate_and_execute(req.question, settings.preview_limit)
+        logger.debug("pattern: no pattern matched, falling back to langchain")
+        result = await agenerate_and_execute(req.question, get_settings().preview_limit)
         return QueryResponse(route="pattern→langchain", **result)
 
     try:
         safe = enforce_select_only(sql)
-        df = pd.read_sql_query(text(safe), get_engine())
+        limit = _row_limit(safe)
+        cols, rows = await run_in_threadpool(_run_select_cached, _inject_top(safe, limit), limit)
     except Exception as e:
-        print(f"[pattern] error, falling back to langchain: {e}")
-        result = generate_and_execute(req.question, settings.preview_limit)
+        logger.warning("pattern: error, falling back to langchain: %s", e)
+        result = await agenerate_and_execute(req.question, get_settings().preview_limit)
         return QueryResponse(route="pattern→langchain", **result)
 
-    df = _trim_df_by_sql(df, safe)
-    total_ms = int((time.perf_counter() - t0) * 1000)
-    return QueryResponse(
-        route="pattern",
-        sql=safe,
-        columns=list(df.columns),
-        rows=df.to_dict(orient="records"),
-        summary_ar=f"Rows: {len(df)} | columns: {', '.join(df.columns[:6])}" + ("..." if len(df.columns) > 6 else ""),
-        model=None,
-        llm_prompt_tokens=0,
-        llm_eval_tokens=0,
-        llm_total_tokens=0,
-        llm_duration_ms=0,
-        total_ms=total_ms,
-    )
+    # rows are already plain JSON values: skip pydantic re-validation and encode with orjson
+    return ORJSONResponse(_build_response("pattern", safe, cols, rows, t0))
 
 
 @router.post("/langchain", response_model=QueryResponse)
-def langchain_route(req: QuestionRequest):
+async def langchain_route(req: QuestionRequest):
     try:
-        result = generate_and_execute(req.question, settings.preview_limit)
+        result = await agenerate_and_execute(req.question, get_settings().preview_limit)
         return QueryResponse(route="langchain", **result)
     except Exception as e:
-        print(f"[langchain] error: {e}")
+        logger.warning("langchain: error: %s", e)
         raise HTTPException(500, f"LLM SQL generation/execution error: {e}")
 
 
 @router.post("/agents", response_model=QueryResponse)
-def agents_route(req: QuestionRequest):
+async def agents_route(req: QuestionRequest):
     try:
         agent = get_agents()
-        result = agent.run(req.question, settings.preview_limit)
+        result = await run_in_threadpool(agent.run, req.question, get_settings().preview_limit)
         return QueryResponse(route="agents", **result)
     except Exception as e:
-        print(f"[agents] route error: {e}")
+        logger.warning("agents: route error: %s", e)
         raise HTTPException(500, f"Agents route error: {e}")
 
 
 @router.post("/run-sql", response_model=QueryResponse)
-def run_sql(req: SQLRunRequest):
+async def run_sql(req: SQLRunRequest):
     t0 = time.perf_counter()
     try:
         safe = enforce_select_only(req.sql)
-        df = pd.read_sql_query(text(safe), get_engine())
+        limit = _row_limit(safe)
+        cols, rows = await run_in_threadpool(fetch_rows, _inject_top(safe, limit), limit)
     except Exception as e:
-        print(f"[run-sql] error: {e}")
+        logger.warning("run-sql: error: %s", e)
         raise HTTPException(500, f"Run-SQL error: {e}")
 
-    df = _trim_df_by_sql(df, safe)
-    total_ms = int((time.perf_counter() - t0) * 1000)
-    return QueryResponse(
-        route="manual-sql",
-        sql=safe,
-        columns=list(df.columns),
-        rows=df.to_dict(orient="records"),
-        summary_ar=f"Rows: {len(df)} | columns: {', '.join(df.columns[:6])}" + ("..." if len(df.columns) > 6 else ""),
-        model=None,
-        llm_prompt_tokens=0,
-        llm_eval_tokens=0,
-        llm_total_tokens=0,
-        llm_duration_ms=0,
-        total_ms=total_ms,
+    # rows are already plain JSON values: skip pydantic re-validation and encode with orjson
+    return ORJSONResponse(_build_response("manual-sql", safe, cols, rows, t0))
+
+
+@router.post("/export")
+async def export_sql(req: SQLRunRequest):
+    """
+    Stream a SELECT as ND-JSON (one row object per line), up to EXPORT_MAX_ROWS rows.
+    If the query fails mid-stream, the last line is {"error": "..."}.
+    """
+    try:
+        safe = enforce_select_only(req.sql)
+        conn, res = await run_in_threadpool(_open_stream, safe)
+    except Exception as e:
+        logger.warning("export: error: %s", e)
+        raise HTTPException(500, f"Export error: {e}")
+    return StreamingResponse(
+        _iter_ndjson(conn, res, get_settings().export_max_rows),
+        media_type="application/x-ndjson",
     )
 
 
 @router.get("/presets", response_model=PresetsList)
-def list_presets():
-    cleaned = {}
-    for k, v in IMPORTANT_QUERIES.items():
-        cleaned[k] = v.strip() if isinstance(v, str) else str(v)
-    return PresetsList(presets=cleaned)
+async def list_presets():
+    return PresetsList(presets=_PRESET_TEXTS)
 
 
 @router.post("/presets/run", response_model=PresetRunResponse)
-def run_preset(name: str = Query(..., description="Preset name (Arabic label).")):
+async def run_preset(name: str = Query(..., description="Preset name (Arabic label).")):
     t0 = time.perf_counter()
-    sql = IMPORTANT_QUERIES.get(name)
-    if not sql:
+    prepared = _PRESETS_PREPARED.get(name)
+    if not prepared:
         raise HTTPException(404, "Preset not found.")
+    safe, limited, limit = prepared
     try:
-        safe = enforce_select_only(sql)
-        df = pd.read_sql_query(text(safe), get_engine())
+        cols, rows = await run_in_threadpool(_run_select_cached, limited, limit)
     except Exception as e:
-        print(f"[presets/run] error: {e}")
+        logger.warning("presets/run: error: %s", e)
         raise HTTPException(500, f"Preset run error: {e}")
 
-    df = _trim_df_by_sql(df, safe)
-    total_ms = int((time.perf_counter() - t0) * 1000)
-    return PresetRunResponse(
-        preset_name=name,
-        route="preset",
-        sql=safe,
-        columns=list(df.columns),
-        rows=df.to_dict(orient="records"),
-        summary_ar=f"Rows: {len(df)} | columns: {', '.join(df.columns[:6])}" + ("..." if len(df.columns) > 6 else ""),
-        model=None,
-        llm_prompt_tokens=0,
-        llm_eval_tokens=0,
-        llm_total_tokens=0,
-        llm_duration_ms=0,
-        total_ms=total_ms,
-    )
+    # rows are already plain JSON values: skip pydantic re-validation and encode with orjson
+    return ORJSONResponse({"preset_name": name, **_build_response("preset", safe, cols, rows, t0)})
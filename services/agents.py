@@ -1,250 +1,224 @@
 # app/services/agents.py
 from __future__ import annotations
 
+import logging
 import os
 import re
+import threading
 import time
-import difflib
-import pandas as pd
-from typing import Dict, Any, Set, Tuple, Optional
-from sqlalchemy import text
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, FrozenSet, List, Tuple, Optional
 
-from app.db.session import get_engine
+from app.db.session import fetch_rows
+from app.services.schema_cache import load_schema
 from app.core.config import settings
 from app.utils.sql_safety import enforce_select_only
 from app.services.ollama_client import generate_with_metrics
 from app.services.langchain_sql import generate_and_execute as lc_generate_and_execute
+from app.services.sql_sanitizer import (
+    extract_sql_any,
+    folded,
+    is_canonical,
+    sanitize_sql,
+    starts_with_select,
+)
+
+logger = logging.getLogger(__name__)
 
 # behavior flags
 AGENTS_EAGER_LOAD = os.getenv("AGENTS_EAGER_LOAD", "false").lower() == "true"
 AGENTS_SCHEMA_RETRY = int(os.getenv("AGENTS_SCHEMA_RETRY", "0"))
+# run the planner and a plan-less writer concurrently (only pays off if Ollama serves requests in parallel)
+AGENTS_SPECULATIVE_WRITER = os.getenv("AGENTS_SPECULATIVE_WRITER", "false").lower() == "true"
 
 _SQL_END = re.compile(r";\s*$")
+# SQL prompts ask for <SQL>...</SQL>: stop generating at the closing tag
+_SQL_STOP = ["</SQL>"]
 _RX_SELECT_OR_WITH = re.compile(r"^\s*(select|with|;with)\b", re.IGNORECASE | re.DOTALL)
-_TAG_BLOCK = re.compile(r"<SQL>\s*([\s\S]+?)\s*</SQL>", re.IGNORECASE)
-_TRIPLE_SQL = re.compile(r"```sql\s*([\s\S]+?)```", re.IGNORECASE)
-_TRIPLE_ANY = re.compile(r"```\s*([\s\S]+?)```", re.IGNORECASE)
-_SQLQUERY_LINE = re.compile(r"SQLQuery:\s*(SELECT[\s\S]+?;)", re.IGNORECASE)
-_FIRST_SELECT_SEMI = re.compile(r"(SELECT[\s\S]+?;)", re.IGNORECASE)
-_FIRST_SELECT_ANY = re.compile(r"(SELECT[\s\S]+)$", re.IGNORECASE)
-_FIRST_WITH_BLOCK = re.compile(r"((?:;?\s*WITH|WITH)\s+[\s\S]+?SELECT[\s\S]+?;)", re.IGNORECASE)
 
-_SCHEMA_CACHE: Dict[str, Set[str]] = {}
+_SCHEMA_RETRY_SLEEP_S = 0.5
 
 
-def _load_schema(timeout_s: int = 0) -> Dict[str, Set[str]]:
+def _load_schema_with_retry(timeout_s: float) -> Dict[str, FrozenSet[str]]:
     """
-    Load schema once. Non-fatal if DB is not ready yet.
+    Load schema, retrying for up to timeout_s. Non-fatal if DB is not ready yet.
     """
-    global _SCHEMA_CACHE
-    if _SCHEMA_CACHE:
-        return _SCHEMA_CACHE
-
     deadline = time.time() + max(0, timeout_s)
-    last_err = None
-    q = """
-    SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME
-    FROM INFORMATION_SCHEMA.COLUMNS
-    WHERE TABLE_SCHEMA='dbo' AND TABLE_NAME IN ('products','selling','buying');
-    """
     while True:
         try:
-            with get_engine().connect() as conn:
-                rows = conn.execute(text(q)).fetchall()
-            tables: Dict[str, Set[str]] = {"products": set(), "selling": set(), "buying": set()}
-            for sch, tn, col in rows:
-                tables[tn.lower()].add(col)
-            _SCHEMA_CACHE = tables
-            return tables
+            return load_schema()
         except Exception as e:
-            last_err = e
             if time.time() >= deadline:
-                print(f"[agents] schema load failed (non-fatal): {e}")
+                logger.warning("schema load failed (non-fatal): %s", e)
                 return {}
+            time.sleep(min(_SCHEMA_RETRY_SLEEP_S, max(0.0, deadline - time.time())))
 
 
-def _allowed_columns_text(tables: Dict[str, Set[str]]) -> str:
-    if not tables:
-        return "Use only tables: [dbo].[products], [dbo].[selling], [dbo].[buying]."
+def _load_schema() -> Dict[str, FrozenSet[str]]:
+    return _load_schema_with_retry(0)
+
+
+_NO_SCHEMA_TEXT = "Use only tables: [dbo].[products], [dbo].[selling], [dbo].[buying]."
+
+
+@lru_cache(maxsize=4)
+def _columns_text(products: FrozenSet[str], selling: FrozenSet[str], buying: FrozenSet[str]) -> str:
     return (
         "Tables and columns (use ONLY these exact names):\n"
-        f"- products: {', '.join(sorted(tables['products']))}\n"
-        f"- selling : {', '.join(sorted(tables['selling']))}\n"
-        f"- buying  : {', '.join(sorted(tables['buying']))}\n"
+        f"- products: {', '.join(sorted(products))}\n"
+        f"- selling : {', '.join(sorted(selling))}\n"
+        f"- buying  : {', '.join(sorted(buying))}\n"
     )
 
 
-_ALIAS_TABLE = {"p": "products", "s": "selling", "b": "buying"}
-_BOUNDARY = r"(?=(?:AND|OR|GROUP\s+BY|ORDER\s+BY|HAVING|JOIN|UNION|;|$))"
-
-_COMMON_SYNONYMS = {
-    r"\b([psb])\.\[?QuantitySelling\]?\b": r"\1.QuantitySold",
-    r"\b([psb])\.\[?BuyingPrice\]?\b": r"\1.CostBuying",
-    r"\b([psb])\.\[?ManufacturerPrice\]?\b": r"\1.ManufacturerCost",
-    r"\b([psb])\.\[?ProductPrice\]?\b": r"\1.ProductSellingPrice",
-}
-_COMMON_TOKENS = {
-    r"\bQuantitySelling\b": "QuantitySold",
-    r"\bBuyingPrice\b": "CostBuying",
-    r"\bManufacturerPrice\b": "ManufacturerCost",
-    r"\bProductPrice\b": "ProductSellingPrice",
-    r"\bAverageSelingPrice\b": "AverageSellingPrice",
-}
-
-
-def _basic_cleanup(sql: str) -> str:
-    s = (sql or "").strip()
-    s = re.sub(r"^\s*\[?SQL\]?\s*:\s*", "", s, flags=re.IGNORECASE)
-    s = s.replace("`", "'")
-    s = re.sub(r"'\s*(AND|OR)\b", r"' \1", s, flags=re.IGNORECASE)
-    s = re.sub(r"GETDATE\(\s*-\s*(\d+)\s*\)", r"DATEADD(day, -\1, GETDATE())", s, flags=re.IGNORECASE)
-    s = re.sub(r"['\"]\s*;$", ";", s)
-    return s
+def _allowed_columns_text(tables: Dict[str, FrozenSet[str]]) -> str:
+    if not tables:
+        return _NO_SCHEMA_TEXT
+    return _columns_text(tables["products"], tables["selling"], tables["buying"])
 
 
-def _normalize_tables(sql: str) -> str:
-    s = sql
-    s = re.sub(r"\bFROM\s+\[?Products\]?\b", "FROM [dbo].[products]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bJOIN\s+\[?Products\]?\b", "JOIN [dbo].[products]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bFROM\s+\[?Selling\]?\b", "FROM [dbo].[selling]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bJOIN\s+\[?Selling\]?\b", "JOIN [dbo].[selling]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bFROM\s+\[?Buying\]?\b", "FROM [dbo].[buying]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bJOIN\s+\[?Buying\]?\b", "JOIN [dbo].[buying]", s, flags=re.IGNORECASE)
-    return s
+_RX_PRODUCTS_ALIAS = (
+    re.compile(r"\bFROM\s+\[dbo\]\.\[products\]\s+(?:AS\s+)?([A-Za-z]\w*)", re.IGNORECASE),
+    re.compile(r"\bJOIN\s+\[dbo\]\.\[products\]\s+(?:AS\s+)?([A-Za-z]\w*)", re.IGNORECASE),
+)
+_RX_AGGREGATE = re.compile(r"\b(SUM|AVG|COUNT|MIN|MAX)\s*\(", re.IGNORECASE)
+_RX_GROUP_BY = re.compile(r"\bGROUP\s+BY\b", re.IGNORECASE)
+_RX_ORDER_BY = re.compile(r"\border\s+by\b", re.IGNORECASE)
+_RX_SELECT_HEAD = re.compile(r"^select\s+", re.IGNORECASE)
+
+
+@lru_cache(maxsize=32)
+def _alias_patterns(alias: str) -> Tuple[re.Pattern, re.Pattern]:
+    # alias is always [A-Za-z]\w*, so it is safe to splice into a pattern
+    return (
+        re.compile(rf"\b{alias}\.\[?ProductCode\]?\b", re.IGNORECASE),
+        re.compile(rf"\b{alias}\.\[?ProductName\]?\b", re.IGNORECASE),
+    )
 
 
-def _best_match(name: str, candidates: Set[str]) -> Optional[str]:
-    nm = name.lower()
-    for c in candidates:
-        if c.lower() == nm:
-            return c
-    matches = difflib.get_close_matches(name, list(candidates), n=1, cutoff=0.65)
-    return matches[0] if matches else None
+@lru_cache(maxsize=32)
+def _alias_code_comma(alias: str) -> re.Pattern:
+    return re.compile(rf"{alias}\.\[?ProductCode\]?\s*,\s*", re.IGNORECASE)
 
 
 def _detect_products_alias(sql: str) -> str:
-    for pat in [
-        r"\bFROM\s+\[dbo\]\.\[products\]\s+(?:AS\s+)?([A-Za-z]\w*)",
-        r"\bJOIN\s+\[dbo\]\.\[products\]\s+(?:AS\s+)?([A-Za-z]\w*)",
-    ]:
-        m = re.search(pat, sql, flags=re.IGNORECASE)
+    for rx in _RX_PRODUCTS_ALIAS:
+        m = rx.search(sql)
         if m:
             return m.group(1)
     return "p"
 
 
-def _schema_correct_alias_columns(sql: str, tables: Dict[str, Set[str]]) -> Tuple[str, int]:
-    fixes = 0
-    s = sql
-    for pat, rep in _COMMON_SYNONYMS.items():
-        s2 = re.sub(pat, rep, s, flags=re.IGNORECASE)
-        if s2 != s:
-            fixes += 1
-            s = s2
-    for pat, rep in _COMMON_TOKENS.items():
-        s = re.sub(pat, rep, s, flags=re.IGNORECASE)
-
-    def repl(m: re.Match) -> str:
-        nonlocal fixes
-        alias, col = m.group(1), m.group(2)
-        table = _ALIAS_TABLE.get(alias.lower())
-        valid = tables.get(table, set()) if table else set()
-        if col in valid:
-            return m.group(0)
-        if valid:
-            sug = _best_match(col, valid)
-            if sug:
-                fixes += 1
-                return f"{alias}.{sug}"
-        return m.group(0)
-
-    s = re.sub(r"\b([psb])\.\[?([A-Za-z_]\w*)\]?\b", repl, s)
-    return s, fixes
-
-
-def _fix_incomplete_predicates(sql: str) -> str:
-    s = sql
-    s = re.sub(
-        r"(\b[psb]\.\[?Date\]?|\bDate\b)\s*(<=|<|>=|>|=)\s*(?=(?:AND|OR|GROUP\s+BY|ORDER\s+BY|HAVING|JOIN|UNION|;|$))",
-        r"\1 \2 GETDATE() ",
-        s,
-        flags=re.IGNORECASE,
-    )
-    s = re.sub(
-        r"(\b[psb]\.\[?Date\]?|\bDate\b)\s+BETWEEN\s+([^\s]+)\s+AND\s*(?=(?:AND|OR|GROUP\s+BY|ORDER\s+BY|HAVING|JOIN|UNION|;|$))",
-        r"\1 BETWEEN \2 AND GETDATE() ",
-        s,
-        flags=re.IGNORECASE,
-    )
-    s = re.sub(r"\s+\b(AND|OR)\b\s*(?=(?:AND|OR|GROUP\s+BY|ORDER\s+BY|HAVING|JOIN|UNION|;|$))", " ", s, flags=re.IGNORECASE)
-    return s
+_AGGREGATE_WORDS = ("sum", "avg", "count", "min", "max")
 
 
-def _inject_top(sql: str) -> str:
-    if re.match(r"^\s*select\b", sql, flags=re.IGNORECASE):
-        if " top " not in sql.lower():
-            return re.sub(r"(?i)^select\s+", "SELECT TOP 200 ", sql, count=1)
-    return sql
+def _starts_with_select_or_with(sql: str) -> bool:
+    """
+    Same as _RX_SELECT_OR_WITH.match(sql), as plain string tests.
+    """
+    i, n = 0, len(sql)
+    while i < n and sql[i].isspace():
+        i += 1
+    head = sql[i:i + 7]
+    if not head.isascii():
+        return _RX_SELECT_OR_WITH.match(sql) is not None
+    low = head.lower()
+    for kw in ("select", "with", ";with"):
+        if low.startswith(kw):
+            nxt = head[len(kw):len(kw) + 1]
+            return not (nxt.isalnum() or nxt == "_")
+    return False
+
+
+def _starts_with_cte(sql: str) -> bool:
+    """
+    sql.lstrip().lower().startswith(("with", ";with")) without copying the whole string.
+    """
+    i, n = 0, len(sql)
+    while i < n and sql[i].isspace():
+        i += 1
+    if sql.startswith(";", i):
+        i += 1
+    return sql[i:i + 4].lower() == "with"
+
+
+_KNOWN_TABLES = ("[dbo].[products]", "[dbo].[selling]", "[dbo].[buying]")
+
+
+def _looks_usable(sql: str) -> bool:
+    """
+    Cheap static check on sanitized writer output: a SELECT over one of our tables.
+    """
+    low = folded(sql)
+    return starts_with_select(sql) and " from " in low and any(t in low for t in _KNOWN_TABLES)
+
+
+def _has_missing_group_by(sql: str, low: Optional[str] = None) -> bool:
+    """
+    Aggregate present without GROUP BY. Plain substring tests rule most SQL out
+    before the regexes run; non-ASCII text always goes to the regexes.
+    `low` is sql.lower() when the caller already has it.
+    """
+    if sql.isascii():
+        if low is None:
+            low = sql.lower()
+        if not any(w in low for w in _AGGREGATE_WORDS):
+            return False
+        if "group" not in low:
+            return _RX_AGGREGATE.search(sql) is not None
+    return _RX_AGGREGATE.search(sql) is not None and _RX_GROUP_BY.search(sql) is None
 
 
 def _enforce_group_by(sql: str) -> str:
-    has_aggr = re.search(r"\b(SUM|AVG|COUNT|MIN|MAX)\s*\(", sql, flags=re.IGNORECASE) is not None
-    has_group = re.search(r"\bGROUP\s+BY\b", sql, flags=re.IGNORECASE) is not None
-    if has_aggr and not has_group:
+    if _has_missing_group_by(sql):
         alias = _detect_products_alias(sql)
-        if not re.search(rf"\b{alias}\.\[?ProductCode\]?\b", sql, flags=re.IGNORECASE):
-            sql = re.sub(r"(?i)^select\s+", f"SELECT {alias}.[ProductCode], ", sql, count=1)
-        if not re.search(rf"(?i)\b{alias}\.\[?ProductName\]?\b", sql):
-            sql = re.sub(
-                rf"(?i){alias}\.\[?ProductCode\]?\s*,\s*",
+        rx_code, rx_name = _alias_patterns(alias)
+        if not rx_code.search(sql):
+            sql = _RX_SELECT_HEAD.sub(f"SELECT {alias}.[ProductCode], ", sql, count=1)
+        if not rx_name.search(sql):
+            sql = _alias_code_comma(alias).sub(
                 f"{alias}.[ProductCode], {alias}.[ProductName], ",
                 sql,
                 count=1,
             )
         grp = f" GROUP BY {alias}.[ProductCode], {alias}.[ProductName] "
-        if re.search(r"(?i)\border\s+by\b", sql):
-            sql = re.sub(r"(?i)\border\s+by\b", grp + "ORDER BY", sql, count=1)
+        if "order" in folded(sql) and _RX_ORDER_BY.search(sql):
+            sql = _RX_ORDER_BY.sub(grp + "ORDER BY", sql, count=1)
         else:
             sql = sql.rstrip(";") + grp + ";"
     return sql
 
 
+def _is_canonical(sql: str) -> bool:
+    """
+    True when the SQL already has the shape the sanitizer produces
+    (stripped, TOP present, GROUP BY for aggregates, [dbo] tables, ends with ';').
+    """
+    if not sql:
+        return False
+    # one lower-cased copy serves both the TOP and the aggregate checks
+    low = sql.lower()
+    return is_canonical(sql, low) and not _has_missing_group_by(sql, low)
+
+
 def _sanitize_sql(sql: str) -> str:
-    s = _basic_cleanup(sql)
-    s = _normalize_tables(s)
-    s = _fix_incomplete_predicates(s)
-    tables = _load_schema(timeout_s=0)
-    s, _ = _schema_correct_alias_columns(s, tables)
-    s = _inject_top(s)
+    if _is_canonical(sql):
+        return sql
+    # the schema is static once loaded, so "loaded yet?" is all the cache key needs
+    return _sanitize_sql_cached(sql, bool(_load_schema()))
+
+
+@lru_cache(maxsize=256)
+def _sanitize_sql_cached(sql: str, schema_loaded: bool) -> str:
+    tables = _load_schema() if schema_loaded else {}
+    s = sanitize_sql(sql, tables, reply_fixes=True)
     s = _enforce_group_by(s)
     if not s.rstrip().endswith(";"):
         s = s.rstrip() + ";"
     return s
 
 
-def _extract_sql_any(text_: str) -> Optional[str]:
-    if not text_:
-        return None
-    t = text_.strip()
-    for rx in (_TAG_BLOCK, _TRIPLE_SQL, _TRIPLE_ANY):
-        m = rx.search(t)
-        if m:
-            return m.group(1).strip()
-    m = _SQLQUERY_LINE.search(t)
-    if m:
-        return m.group(1).strip()
-    m = _FIRST_SELECT_SEMI.search(t)
-    if m:
-        return m.group(1).strip()
-    m = _FIRST_WITH_BLOCK.search(t)
-    if m:
-        return m.group(1).strip()
-    m = _FIRST_SELECT_ANY.search(t)
-    if m:
-        return m.group(1).strip()
-    return None
-
-
 def _rewrite_cte_to_select(raw: str, timeout_s: float, num_predict: int) -> str:
     prompt = (
         "Rewrite the following T-SQL into ONE single SELECT statement (NO CTE/NO WITH). "
@@ -252,10 +226,10 @@ def _rewrite_cte_to_select(raw: str, timeout_s: float, num_predict: int) -> str:
         f"{raw}\n\n"
         "<SQL>\nSELECT ... ;\n</SQL>\n"
     )
-    out = generate_with_metrics(prompt, timeout_seconds=timeout_s, num_predict=num_predict)
+    out = generate_with_metrics(prompt, timeout_seconds=timeout_s, num_predict=num_predict, stop=_SQL_STOP)
     if out.get("error"):
         raise ValueError(f"LLM did not return SQL (rewrite): {out['error']}")
-    ex = _extract_sql_any(out["text"])
+    ex = extract_sql_any(out["text"])
     if not ex:
         raise ValueError("LLM did not return SQL (rewrite)")
     return ex
@@ -284,6 +258,8 @@ class AgentOrchestrator:
             "llm_duration_ms": 0,
             "wall_ms": 0,
         }
+        # the speculative planner and writer report usage from two threads
+        self._metrics_lock = threading.Lock()
         self._allowed_text: Optional[str] = None
 
         self.agent_timeout_s = float(_parse_timeout(getattr(settings, "OLLAMA_AGENT_TIMEOUT", "8s")))
@@ -291,22 +267,31 @@ class AgentOrchestrator:
         self.num_predict = int(getattr(settings, "ollama_num_predict", 96))
 
         if AGENTS_EAGER_LOAD and AGENTS_SCHEMA_RETRY > 0:
-            tables = _load_schema(timeout_s=AGENTS_SCHEMA_RETRY)
+            tables = _load_schema_with_retry(AGENTS_SCHEMA_RETRY)
             self._allowed_text = _allowed_columns_text(tables)
 
     def _ensure_allowed_text(self) -> None:
-        if self._allowed_text is None:
-            tables = _load_schema(timeout_s=0)
+        # re-check while only the no-schema fallback is known
+        if self._allowed_text is None or self._allowed_text is _NO_SCHEMA_TEXT:
+            tables = _load_schema()
             self._allowed_text = _allowed_columns_text(tables)
 
     def _acc(self, m: Dict[str, Any]) -> None:
-        if not self.metrics["model"] and m.get("model"):
-            self.metrics["model"] = m["model"]
-        self.metrics["prompt_tokens"] += int(m.get("prompt_eval_count", 0))
-        self.metrics["eval_tokens"] += int(m.get("eval_count", 0))
-        self.metrics["llm_duration_ms"] += int(m.get("total_duration_ms", 0))
-
-    def _call_llm(self, prompt: str, start_t: float) -> str:
+        with self._metrics_lock:
+            if not self.metrics["model"] and m.get("model"):
+                self.metrics["model"] = m["model"]
+            self.metrics["prompt_tokens"] += int(m.get("prompt_eval_count", 0))
+            self.metrics["eval_tokens"] += int(m.get("eval_count", 0))
+            self.metrics["llm_duration_ms"] += int(m.get("total_duration_ms", 0))
+
+    def _call_llm(
+        self, prompt: str, start_t: float, stop: Optional[list[str]] = None,
+        usage: Optional[List[Dict[str, Any]]] = None,
+    ) -> str:
+        """
+        `usage`, when given, collects the call's metrics instead of adding them to
+        self.metrics, so the caller can drop them if the reply goes unused.
+        """
         if (time.perf_counter() - start_t) >= self.hard_deadline_s:
             raise TimeoutError("agents budget exceeded")
 
@@ -314,13 +299,19 @@ class AgentOrchestrator:
             prompt,
             timeout_seconds=self.agent_timeout_s,
             num_predict=self.num_predict,
+            stop=stop,
         )
         if out.get("error"):
             raise RuntimeError(f"Ollama returned error: {out['error']}")
-        self._acc(out)
+        if usage is None:
+            self._acc(out)
+        else:
+            usage.append(out)
         return (out.get("text") or "").strip()
 
-    def _planner(self, question: str, start_t: float) -> str:
+    def _planner(
+        self, question: str, start_t: float, usage: Optional[List[Dict[str, Any]]] = None
+    ) -> str:
         self._ensure_allowed_text()
         prompt = (
             "You are a BI planner for a Pharmacy SQL Server DB.\n"
@@ -329,7 +320,7 @@ class AgentOrchestrator:
             f"Question: {question}\n\n"
             "Plan:"
         )
-        return self._call_llm(prompt, start_t)
+        return self._call_llm(prompt, start_t, usage=usage)
 
     def _writer(self, question: str, plan: str, start_t: float) -> str:
         self._ensure_allowed_text()
@@ -347,11 +338,11 @@ class AgentOrchestrator:
             f"Question: {question}\n\n"
             "Return ONLY inside tags:\n<SQL>\nSELECT ... ;\n</SQL>\n"
         )
-        raw = self._call_llm(prompt, start_t)
-        extracted = _extract_sql_any(raw)
+        raw = self._call_llm(prompt, start_t, stop=_SQL_STOP)
+        extracted = extract_sql_any(raw)
         if not extracted:
             raise ValueError("LLM did not return SQL")
-        if extracted.lstrip().lower().startswith(("with", ";with")):
+        if _starts_with_cte(extracted):
             extracted = _rewrite_cte_to_select(extracted, self.agent_timeout_s, self.num_predict)
         sql = enforce_select_only(extracted if extracted.endswith(";") else extracted + ";")
         sql = _sanitize_sql(sql)
@@ -359,10 +350,14 @@ class AgentOrchestrator:
             sql += ";"
         return sql
 
-    def _tester(self, sql: str, start_t: float) -> str:
+    def _tester(self, sql: str, start_t: float, sanitized: bool = False) -> str:
+        """
+        Repair SQL that does not start with SELECT/WITH. `sanitized` marks _writer
+        output, which has been through _sanitize_sql already.
+        """
         self._ensure_allowed_text()
-        sql0 = _sanitize_sql(sql)
-        if not _RX_SELECT_OR_WITH.match(sql0):
+        sql0 = sql if sanitized else _sanitize_sql(sql)
+        if not _starts_with_select_or_with(sql0):
             prompt = (
                 "Fix this into ONE valid T-SQL SELECT ONLY for SQL Server. "
                 "NO CTE. No prose. End with a semicolon.\n\n"
@@ -370,32 +365,61 @@ class AgentOrchestrator:
                 f"{sql0}\n\n"
                 "<SQL>\nSELECT ... ;\n</SQL>\n"
             )
-            raw = self._call_llm(prompt, start_t)
-            extracted = _extract_sql_any(raw)
+            raw = self._call_llm(prompt, start_t, stop=_SQL_STOP)
+            extracted = extract_sql_any(raw)
             if not extracted:
                 raise ValueError("LLM did not return SQL (tester)")
-            if extracted.lstrip().lower().startswith(("with", ";with")):
+            if _starts_with_cte(extracted):
                 extracted = _rewrite_cte_to_select(extracted, self.agent_timeout_s, self.num_predict)
             sql0 = enforce_select_only(extracted if extracted.endswith(";") else extracted + ";")
         return _sanitize_sql(sql0)
 
-    def run(self, question: str, preview_limit: int) -> Dict[str, Any]:
-        start = time.perf_counter()
+    def _plan_and_write_speculative(self, question: str, start_t: float) -> Tuple[Optional[str], str]:
+        """
+        Start the planner and a plan-less writer together. Keep the plan-less SQL if it
+        already looks usable; otherwise wait for the plan and write again with it.
+        """
+        ex = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agents")
+        # the planner may outlive this call; its metrics count only if the plan is used
+        plan_usage: List[Dict[str, Any]] = []
         try:
-            plan = self._planner(question, start)
-            if (time.perf_counter() - start) >= self.hard_deadline_s:
+            fut_plan = ex.submit(self._planner, question, start_t, plan_usage)
+            fut_sql = ex.submit(self._writer, question, "", start_t)
+            try:
+                sql = fut_sql.result()
+            except Exception as e:
+                logger.debug("speculative writer failed, waiting for plan: %s", e)
+                sql = None
+            if sql and _looks_usable(sql):
+                return None, sql
+
+            plan = fut_plan.result()
+            for m in plan_usage:
+                self._acc(m)
+            if (time.perf_counter() - start_t) >= self.hard_deadline_s:
                 raise TimeoutError("agents budget exceeded after planner")
+            return plan, self._writer(question, plan, start_t)
+        finally:
+            # never block on a planner call that is no longer needed
+            ex.shutdown(wait=False, cancel_futures=True)
 
-            raw_sql = self._writer(question, plan, start)
+    def run(self, question: str, preview_limit: int) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            if AGENTS_SPECULATIVE_WRITER:
+                plan, raw_sql = self._plan_and_write_speculative(question, start)
+            else:
+                plan = self._planner(question, start)
+                if (time.perf_counter() - start) >= self.hard_deadline_s:
+                    raise TimeoutError("agents budget exceeded after planner")
+                raw_sql = self._writer(question, plan, start)
             if (time.perf_counter() - start) >= self.hard_deadline_s:
                 raise TimeoutError("agents budget exceeded after writer")
 
-            final_sql = self._tester(raw_sql, start)
+            final_sql = self._tester(raw_sql, start, sanitized=True)
 
             safe_sql = enforce_select_only(final_sql)
-            df = pd.read_sql_query(text(safe_sql), get_engine())
-            if len(df) > preview_limit:
-                df = df.head(preview_limit)
+            cols, rows = fetch_rows(safe_sql, preview_limit)
 
             total_ms = int((time.perf_counter() - start) * 1000)
             self.metrics["wall_ms"] = total_ms
@@ -403,11 +427,11 @@ class AgentOrchestrator:
             return {
                 "sql": safe_sql,
                 "plan": plan,
-                "columns": list(df.columns),
-                "rows": df.to_dict(orient="records"),
+                "columns": cols,
+                "rows": rows,
                 "summary_ar": (
-                    f"Rows: {len(df)} | columns: {', '.join(df.columns[:6])}"
-                    + ("..." if len(df.columns) > 6 else "")
+                    f"Rows: {len(rows)} | columns: {', '.join(cols[:6])}"
+                    + ("..." if len(cols) > 6 else "")
                 ),
                 "model": self.metrics["model"],
                 "llm_prompt_tokens": self.metrics["prompt_tokens"],
@@ -419,7 +443,7 @@ class AgentOrchestrator:
 
         except Exception as e:
             # hard fallback to langchain route (which also has Ollama fallback now)
-            print(f"[agents] error, using langchain fallback: {e}")
+            logger.warning("error, using langchain fallback: %s", e)
             res = lc_generate_and_execute(question, preview_limit)
             res["via_fallback"] = True
             return res
@@ -1,17 +1,21 @@
 # app/services/langchain_sql.py
 from __future__ import annotations
 
+import asyncio
+import logging
 import re
 import time
-import difflib
-import pandas as pd
-from typing import Dict, Any, Set, Tuple
-from sqlalchemy import text
+from functools import lru_cache
+from typing import Dict, Any, FrozenSet, Generator, List, Optional, Tuple
 
 from app.core.config import settings
-from app.db.session import get_engine
+from app.db.session import fetch_rows
+from app.services.schema_cache import load_schema
+from app.services.sql_sanitizer import is_canonical, sanitize_sql
 from app.utils.sql_safety import enforce_select_only
-from app.services.ollama_client import generate_with_metrics
+from app.services.ollama_client import agenerate_with_metrics, generate_with_metrics
+
+logger = logging.getLogger(__name__)
 
 # optional original helper
 try:
@@ -20,227 +24,174 @@ except Exception:
     get_few_shot_db_chain = None  # type: ignore
 
 _SQL_END = re.compile(r";\s*$")
-_RX_SELECT = re.compile(r"^\s*(select|with|;with)\b", re.IGNORECASE | re.DOTALL)
-
-# in-memory schema cache
-_SCHEMA_CACHE: Dict[str, Set[str]] = {}
+_TAG_BLOCK = re.compile(r"<SQL>\s*([\s\S]+?)\s*</SQL>", re.IGNORECASE)
 
 
-def _load_schema() -> Dict[str, Set[str]]:
-    """
-    Load columns from INFORMATION_SCHEMA for the 3 tables we care about.
+def _load_schema() -> Dict[str, FrozenSet[str]]:
     """
-    global _SCHEMA_CACHE
-    if _SCHEMA_CACHE:
-        return _SCHEMA_CACHE
-    q = """
-    SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME
-    FROM INFORMATION_SCHEMA.COLUMNS
-    WHERE TABLE_SCHEMA='dbo' AND TABLE_NAME IN ('products','selling','buying');
+    Columns for the 3 tables we care about (shared cache; raises until the DB answers).
     """
-    with get_engine().connect() as conn:
-        rows = conn.execute(text(q)).fetchall()
-    tables: Dict[str, Set[str]] = {"products": set(), "selling": set(), "buying": set()}
-    for sch, tn, col in rows:
-        tables[tn.lower()].add(col)
-    _SCHEMA_CACHE = tables
-    return tables
+    return load_schema()
+
+
+# prompt block built from the schema; static once the schema is loaded
+_ALLOWED_TEXT: Optional[str] = None
 
 
 def _allowed_text() -> str:
+    global _ALLOWED_TEXT
+    if _ALLOWED_TEXT is not None:
+        return _ALLOWED_TEXT
     t = _load_schema()
-    return (
+    _ALLOWED_TEXT = (
         "Tables and columns (use ONLY these exact names):\n"
         f"- products: {', '.join(sorted(t['products']))}\n"
         f"- selling : {', '.join(sorted(t['selling']))}\n"
         f"- buying  : {', '.join(sorted(t['buying']))}\n"
     )
+    return _ALLOWED_TEXT
 
 
-# --- same sanitizers as agents ---
-_ALIAS_TABLE = {"p": "products", "s": "selling", "b": "buying"}
-_BOUNDARY = r"(?=(?:AND|OR|GROUP\s+BY|ORDER\s+BY|HAVING|JOIN|UNION|;|$))"
-
-_COMMON_SYNONYMS = {
-    r"\b([psb])\.\[?QuantitySelling\]?\b": r"\1.QuantitySold",
-    r"\b([psb])\.\[?BuyingPrice\]?\b": r"\1.CostBuying",
-    r"\b([psb])\.\[?ManufacturerPrice\]?\b": r"\1.ManufacturerCost",
-    r"\b([psb])\.\[?ProductPrice\]?\b": r"\1.ProductSellingPrice",
-}
-_COMMON_TOKENS = {
-    r"\bQuantitySelling\b": "QuantitySold",
-    r"\bBuyingPrice\b": "CostBuying",
-    r"\bManufacturerPrice\b": "ManufacturerCost",
-    r"\bProductPrice\b": "ProductSellingPrice",
-    r"\bAverageSelingPrice\b": "AverageSellingPrice",
-}
+def _sanitize_sql(sql: str) -> str:
+    # already-clean model output skips the pipeline (and the cache lookup)
+    if is_canonical(sql):
+        return sql
+    return _sanitize_sql_cached(sql)
 
 
-def _basic_cleanup(sql: str) -> str:
-    s = (sql or "").strip()
-    s = s.replace("`", "'")
-    s = re.sub(r"'\s*(AND|OR)\b", r"' \1", s, flags=re.IGNORECASE)
-    s = re.sub(r"GETDATE\(\s*-\s*(\d+)\s*\)", r"DATEADD(day, -\1, GETDATE())", s, flags=re.IGNORECASE)
+# pure once the schema is loaded (_load_schema raises, uncached, until it is)
+@lru_cache(maxsize=512)
+def _sanitize_sql_cached(sql: str) -> str:
+    s = sanitize_sql(sql, _load_schema())
+    if not s.rstrip().endswith(";"):
+        s = s.rstrip() + ";"
     return s
 
 
-def _normalize_tables(sql: str) -> str:
-    s = sql
-    s = re.sub(r"\bFROM\s+\[?Products\]?\b", "FROM [dbo].[products]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bJOIN\s+\[?Products\]?\b", "JOIN [dbo].[products]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bFROM\s+\[?Selling\]?\b", "FROM [dbo].[selling]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bJOIN\s+\[?Selling\]?\b", "JOIN [dbo].[selling]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bFROM\s+\[?Buying\]?\b", "FROM [dbo].[buying]", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bJOIN\s+\[?Buying\]?\b", "JOIN [dbo].[buying]", s, flags=re.IGNORECASE)
-    return s
+_PROMPT_TEMPLATE = (
+    "You are a senior SQL Server engineer. Generate ONLY one T-SQL SELECT.\n\n"
+    "{allowed}"
+    "\nRules:\n"
+    "- SQL Server syntax only. No comments, no prose.\n"
+    "- Use explicit schema [dbo].\n"
+    "- Use aliases: [p]=[dbo].[products], [s]=[dbo].[selling], [b]=[dbo].[buying].\n"
+    "- If aggregating, GROUP BY [p].[ProductCode], [p].[ProductName].\n"
+    "- End with a semicolon.\n\n"
+    "Question: {q}\n\n"
+    "<SQL>\nSELECT ... ;\n</SQL>\n"
+)
+_REPAIR_TEMPLATE = (
+    "Fix the following into ONE valid T-SQL SELECT ONLY for SQL Server. "
+    "Use ONLY the listed columns. No prose. End with a semicolon.\n\n"
+    "{allowed}"
+    "\n-- DB error:\n{err}\n\n-- SQL:\n{sql}\n\n"
+    "<SQL>\nSELECT ... ;\n</SQL>\n"
+)
 
 
-def _best_match(name: str, candidates: Set[str]) -> str | None:
-    nm = name.lower()
-    for c in candidates:
-        if c.lower() == nm:
-            return c
-    matches = difflib.get_close_matches(name, list(candidates), n=1, cutoff=0.65)
-    return matches[0] if matches else None
-
-
-def _schema_correct_alias_columns(sql: str, tables: Dict[str, Set[str]]) -> Tuple[str, int]:
-    fixes = 0
-    s = sql
-    for pat, rep in _COMMON_SYNONYMS.items():
-        s2 = re.sub(pat, rep, s, flags=re.IGNORECASE)
-        if s2 != s:
-            fixes += 1
-            s = s2
-    for pat, rep in _COMMON_TOKENS.items():
-        s = re.sub(pat, rep, s, flags=re.IGNORECASE)
-
-    def repl(m: re.Match) -> str:
-        nonlocal fixes
-        alias, col = m.group(1), m.group(2)
-        table = _ALIAS_TABLE.get(alias.lower())
-        valid = tables.get(table, set()) if table else set()
-        if col in valid:
-            return m.group(0)
-        if valid:
-            sug = _best_match(col, valid)
-            if sug:
-                fixes += 1
-                return f"{alias}.{sug}"
-        return m.group(0)
-
-    s = re.sub(r"\b([psb])\.\[?([A-Za-z_]\w*)\]?\b", repl, s)
-    return s, fixes
-
-
-def _fix_incomplete_predicates(sql: str) -> str:
-    s = sql
-    s = re.sub(
-        rf"(\b[psb]\.\[?Date\]?|\bDate\b)\s*(<=|<|>=|>|=)\s*{_BOUNDARY}",
-        r"\1 \2 GETDATE() ",
-        s,
-        flags=re.IGNORECASE,
-    )
-    s = re.sub(
-        rf"(\b[psb]\.\[?Date\]?|\bDate\b)\s+BETWEEN\s+([^\s]+)\s+AND\s*{_BOUNDARY}",
-        r"\1 BETWEEN \2 AND GETDATE() ",
-        s,
-        flags=re.IGNORECASE,
-    )
-    s = re.sub(rf"\s+\b(AND|OR)\b\s*{_BOUNDARY}", " ", s, flags=re.IGNORECASE)
-    return s
+def _fallback_sql() -> str:
+    """
+    Fallback when LLM is not reachable.
+    """
+    return "SELECT TOP 50 [ProductCode], [ProductName] FROM [dbo].[products];"
 
 
-def _inject_top(sql: str) -> str:
-    if re.match(r"^\s*select\b", sql, flags=re.IGNORECASE):
-        if " top " not in sql.lower():
-            return re.sub(r"(?i)^select\s+", "SELECT TOP 200 ", sql, count=1)
-    return sql
+def _ollama_prompt(question: str) -> str:
+    return _PROMPT_TEMPLATE.format_map({"allowed": _allowed_text(), "q": question})
 
 
-def _sanitize_sql(sql: str) -> str:
-    s = _basic_cleanup(sql)
-    s = _normalize_tables(s)
-    s = _fix_incomplete_predicates(s)
-    tables = _load_schema()
-    s, _ = _schema_correct_alias_columns(s, tables)
-    s = _inject_top(s)
-    if not s.rstrip().endswith(";"):
-        s = s.rstrip() + ";"
-    return s
+def _repair_prompt(err: Exception, sql: str) -> str:
+    return _REPAIR_TEMPLATE.format_map({"allowed": _allowed_text(), "err": err, "sql": sql})
 
 
-def _fallback_sql() -> str:
+def _sql_from_reply(raw_text: str) -> str:
+    # extract SQL from tags
+    m = _TAG_BLOCK.search(raw_text or "")
+    sql_raw = (m.group(1).strip() if m else raw_text.strip())
+    return _sanitize_sql(enforce_select_only(sql_raw))
+
+
+# settings are fixed for the process: resolve the Ollama options once
+_OLLAMA_KWARGS: Dict[str, Any] = {
+    "stop": ["</SQL>"],
+    "timeout_seconds": getattr(settings, "ollama_timeout", 12),
+    "num_predict": getattr(settings, "ollama_num_predict", 128),
+}
+_MODEL_NAME = getattr(settings, "ollama_model", None) or "llama3"
+
+
+def _result(
+    sql: str, cols: List[str], rows: List[Dict[str, Any]], model_name: Optional[str],
+    ptok: int, etok: int, llm_ms: int, t0: float,
+) -> Dict[str, Any]:
+    total_ms = int((time.perf_counter() - t0) * 1000)
+    return {
+        "sql": sql,
+        "columns": cols,
+        "rows": rows,
+        "summary_ar": (
+            f"Rows: {len(rows)} | columns: {', '.join(cols[:6])}"
+            + ("..." if len(cols) > 6 else "")
+        ),
+        "model": model_name,
+        "llm_prompt_tokens": ptok,
+        "llm_eval_tokens": etok,
+        "llm_total_tokens": ptok + etok,
+        "llm_duration_ms": llm_ms,
+        "total_ms": total_ms,
+    }
+
+
+def _run_chain(question: str) -> Tuple[Optional[str], int]:
     """
-    Fallback when LLM is not reachable.
+    Try your existing langchain chain; returns (reply, llm_ms), reply None on failure.
     """
-    return "SELECT TOP 50 [ProductCode], [ProductName] FROM [dbo].[products];"
+    if get_few_shot_db_chain is None:
+        return None, 0
+    try:
+        chain = get_few_shot_db_chain()
+        start_llm = time.perf_counter()
+        res = chain.invoke({"query": question})
+        llm_ms = int((time.perf_counter() - start_llm) * 1000)
+        return (res.get("result") if isinstance(res, dict) else str(res)), llm_ms
+    except Exception as e:
+        logger.warning("few_shot chain error: %s", e)
+        return None, 0
 
 
-def generate_and_execute(question: str, preview_limit: int) -> Dict[str, Any]:
+# marks a step that calls Ollama; every other step is a blocking call
+_LLM = object()
+
+# a pipeline step: (function or _LLM, args, kwargs)
+_Step = Tuple[Any, tuple, Dict[str, Any]]
+
+
+def _pipeline(question: str, preview_limit: int) -> Generator[_Step, Any, Dict[str, Any]]:
     """
-    Main LLM → SQL → DB pipeline.
-    If Ollama is not reachable we return a predefined fallback query.
+    LLM → SQL → DB pipeline, shared by the sync and async entry points.
+    Yields each blocking or Ollama call for the caller to run and is sent its
+    result (or thrown its exception).
     """
     t0 = time.perf_counter()
 
-    raw_text = None
-    model_name = getattr(settings, "ollama_model", None) or "llama3"
-    ptok = etok = llm_ms = 0
+    model_name = _MODEL_NAME
+    ptok = etok = 0
 
     # 1) try your existing langchain chain
-    if get_few_shot_db_chain is not None:
-        try:
-            chain = get_few_shot_db_chain()
-            start_llm = time.perf_counter()
-            res = chain.invoke({"query": question})
-            llm_ms = int((time.perf_counter() - start_llm) * 1000)
-            raw_text = res.get("result") if isinstance(res, dict) else str(res)
-        except Exception as e:
-            print(f"[langchain_sql] few_shot chain error: {e}")
-            raw_text = None
+    raw_text, llm_ms = yield _run_chain, (question,), {}
 
     # 2) fallback to Ollama if above failed
     if not raw_text:
-        prompt = (
-            "You are a senior SQL Server engineer. Generate ONLY one T-SQL SELECT.\n\n"
-            + _allowed_text()
-            + "\nRules:\n"
-            "- SQL Server syntax only. No comments, no prose.\n"
-            "- Use explicit schema [dbo].\n"
-            "- Use aliases: [p]=[dbo].[products], [s]=[dbo].[selling], [b]=[dbo].[buying].\n"
-            "- If aggregating, GROUP BY [p].[ProductCode], [p].[ProductName].\n"
-            "- End with a semicolon.\n\n"
-            f"Question: {question}\n\n"
-            "<SQL>\nSELECT ... ;\n</SQL>\n"
-        )
-        out = generate_with_metrics(
-            prompt,
-            stop=["</SQL>"],
-            timeout_seconds=getattr(settings, "ollama_timeout", 12),
-            num_predict=getattr(settings, "ollama_num_predict", 128),
-        )
+        # the prompt reads the schema from the DB on first use
+        prompt = yield _ollama_prompt, (question,), {}
+        out = yield _LLM, (prompt,), _OLLAMA_KWARGS
 
         if out.get("error"):
             # Ollama is down or returned bad JSON → fallback
-            print(f"[langchain_sql] Ollama error: {out['error']}")
+            logger.warning("Ollama error: %s", out["error"])
             sql = _fallback_sql()
-            df = pd.read_sql_query(text(sql), get_engine())
-            if len(df) > preview_limit:
-                df = df.head(preview_limit)
-            total_ms = int((time.perf_counter() - t0) * 1000)
-            return {
-                "sql": sql,
-                "columns": list(df.columns),
-                "rows": df.to_dict(orient="records"),
-                "summary_ar": f"Rows: {len(df)} | columns: {', '.join(df.columns[:6])}" + ("..." if len(df.columns) > 6 else ""),
-                "model": None,
-                "llm_prompt_tokens": 0,
-                "llm_eval_tokens": 0,
-                "llm_total_tokens": 0,
-                "llm_duration_ms": 0,
-                "total_ms": total_ms,
-            }
+            cols, rows = yield fetch_rows, (sql, preview_limit), {}
+            return _result(sql, cols, rows, None, 0, 0, 0, t0)
 
         raw_text = out["text"] or ""
         model_name = out.get("model") or model_name
@@ -248,55 +199,63 @@ def generate_and_execute(question: str, preview_limit: int) -> Dict[str, Any]:
         etok = int(out.get("eval_count", 0))
         llm_ms = int(out.get("total_duration_ms", 0))
 
-    # extract SQL from tags
-    m = re.search(r"<SQL>\s*([\s\S]+?)\s*</SQL>", raw_text or "", flags=re.IGNORECASE)
-    sql_raw = (m.group(1).strip() if m else raw_text.strip())
-    sql = enforce_select_only(sql_raw)
-    sql = _sanitize_sql(sql)
+    sql = yield _sql_from_reply, (raw_text,), {}
 
     try:
-        df = pd.read_sql_query(text(sql), get_engine())
+        cols, rows = yield fetch_rows, (sql, preview_limit), {}
     except Exception as err:
         # guided repair using Ollama again
-        fix_prompt = (
-            "Fix the following into ONE valid T-SQL SELECT ONLY for SQL Server. "
-            "Use ONLY the listed columns. No prose. End with a semicolon.\n\n"
-            + _allowed_text()
-            + f"\n-- DB error:\n{err}\n\n-- SQL:\n{sql}\n\n"
-              "<SQL>\nSELECT ... ;\n</SQL>\n"
-        )
-        out2 = generate_with_metrics(fix_prompt, stop=["</SQL>"])
+        prompt = yield _repair_prompt, (err, sql), {}
+        out2 = yield _LLM, (prompt,), {"stop": ["</SQL>"]}
         if out2.get("error"):
-            print(f"[langchain_sql] repair also failed with Ollama: {out2['error']}")
+            logger.warning("repair also failed with Ollama: %s", out2["error"])
             sql = _fallback_sql()
         else:
-            raw2 = out2["text"] or ""
-            m2 = re.search(r"<SQL>\s*([\s\S]+?)\s*</SQL>", raw2, flags=re.IGNORECASE)
-            sql2 = enforce_select_only((m2.group(1).strip() if m2 else raw2).strip())
-            sql2 = _sanitize_sql(sql2)
-            sql = sql2
-        df = pd.read_sql_query(text(sql), get_engine())
+            sql = yield _sql_from_reply, (out2["text"] or "",), {}
+        cols, rows = yield fetch_rows, (sql, preview_limit), {}
         ptok += int(out2.get("prompt_eval_count", 0))
         etok += int(out2.get("eval_count", 0))
         llm_ms += int(out2.get("total_duration_ms", 0))
 
-    if len(df) > preview_limit:
-        df = df.head(preview_limit)
+    return _result(sql, cols, rows, model_name, ptok, etok, llm_ms, t0)
 
-    total_ms = int((time.perf_counter() - t0) * 1000)
 
-    return {
-        "sql": sql,
-        "columns": list(df.columns),
-        "rows": df.to_dict(orient="records"),
-        "summary_ar": (
-            f"Rows: {len(df)} | columns: {', '.join(df.columns[:6])}"
-            + ("..." if len(df.columns) > 6 else "")
-        ),
-        "model": model_name,
-        "llm_prompt_tokens": ptok,
-        "llm_eval_tokens": etok,
-        "llm_total_tokens": ptok + etok,
-        "llm_duration_ms": llm_ms,
-        "total_ms": total_ms,
-    }
+def generate_and_execute(question: str, preview_limit: int) -> Dict[str, Any]:
+    """
+    Main LLM → SQL → DB pipeline.
+    If Ollama is not reachable we return a predefined fallback query.
+    """
+    steps = _pipeline(question, preview_limit)
+    advance, value = steps.send, None
+    while True:
+        try:
+            fn, args, kwargs = advance(value)
+        except StopIteration as done:
+            return done.value
+        try:
+            value = (generate_with_metrics if fn is _LLM else fn)(*args, **kwargs)
+            advance = steps.send
+        except Exception as e:
+            advance, value = steps.throw, e
+
+
+async def agenerate_and_execute(question: str, preview_limit: int) -> Dict[str, Any]:
+    """
+    generate_and_execute for async routes: LLM calls are awaited over httpx and
+    the blocking chain/schema/DB calls run in worker threads, so no thread idles on Ollama.
+    """
+    steps = _pipeline(question, preview_limit)
+    advance, value = steps.send, None
+    while True:
+        try:
+            fn, args, kwargs = advance(value)
+        except StopIteration as done:
+            return done.value
+        try:
+            if fn is _LLM:
+                value = await agenerate_with_metrics(*args, **kwargs)
+            else:
+                value = await asyncio.to_thread(fn, *args, **kwargs)
+            advance = steps.send
+        except Exception as e:
+            advance, value = steps.throw, e
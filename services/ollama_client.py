@@ -1,15 +1,117 @@
 # app/services/ollama_client.py
+import logging
 import os
-import json
+from functools import lru_cache
+from types import SimpleNamespace
+
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Any, Dict, Optional
 
+logger = logging.getLogger(__name__)
+
 
 def _ollama_base_url() -> str:
     # you can change this with OLLAMA_BASE_URL in env
     return os.getenv("OLLAMA_BASE_URL", "http://host.docker.internal:11434")
 
 
+@lru_cache(maxsize=1)
+def _ollama_cfg() -> SimpleNamespace:
+    """
+    Env-derived Ollama settings, read once per process (cache_clear() after changing the env).
+    """
+    return SimpleNamespace(
+        generate_url=f"{_ollama_base_url().rstrip('/')}/api/generate",
+        model=os.getenv("OLLAMA_MODEL", "llama3"),
+    )
+
+
+@lru_cache(maxsize=1)
+def _session() -> requests.Session:
+    """
+    One keep-alive session per process, so LLM calls skip the TCP (and TLS) handshake.
+    """
+    s = requests.Session()
+    # room for the concurrent planner/writer calls and the health probe
+    s.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return s
+
+
+@lru_cache(maxsize=1)
+def _async_client() -> httpx.AsyncClient:
+    """
+    Keep-alive client for the async routes; created on first use inside the server's event loop.
+    """
+    return httpx.AsyncClient(limits=httpx.Limits(max_connections=8, max_keepalive_connections=4))
+
+
+async def aclose_async_client() -> None:
+    if _async_client.cache_info().currsize:
+        await _async_client().aclose()
+        _async_client.cache_clear()
+
+
+def _payload(prompt: str, model: Optional[str], num_predict: int, stop: Optional[list[str]]) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {
+        "model": model or _ollama_cfg().model,
+        "prompt": prompt,
+        "stream": True,  # ollama streams by default
+        "options": {
+            "num_predict": num_predict,
+        },
+    }
+    if stop:
+        # Ollama reads stop sequences from options and ends generation server-side
+        payload["options"]["stop"] = stop
+    return payload
+
+
+class _StreamResult:
+    """
+    Collects text and metrics from Ollama's streamed JSON objects.
+    """
+
+    __slots__ = ("full_text", "total_duration_ms", "model_name", "prompt_eval_count", "eval_count")
+
+    def __init__(self) -> None:
+        self.full_text: list[str] = []
+        self.total_duration_ms = 0
+        self.model_name = None
+        self.prompt_eval_count = 0
+        self.eval_count = 0
+
+    def add(self, obj: Dict[str, Any]) -> None:
+        # collect text
+        if "response" in obj and obj["response"]:
+            self.full_text.append(obj["response"])
+
+        # collect metrics if present
+        if "model" in obj and not self.model_name:
+            self.model_name = obj["model"]
+        if "total_duration" in obj:
+            self.total_duration_ms = int(obj["total_duration"] / 1_000_000)
+        if "prompt_eval_count" in obj:
+            self.prompt_eval_count = int(obj["prompt_eval_count"])
+        if "eval_count" in obj:
+            self.eval_count = int(obj["eval_count"])
+
+    def partial(self, err: Exception) -> Dict[str, Any]:
+        return {"text": "".join(self.full_text), "error": str(err)}
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "text": "".join(self.full_text).strip(),
+            "model": self.model_name,
+            "total_duration_ms": self.total_duration_ms,
+            "prompt_eval_count": self.prompt_eval_count,
+            "eval_count": self.eval_count,
+        }
+
+
 def generate_with_metrics(
     prompt: str,
     model: Optional[str] = None,
@@ -22,67 +124,73 @@ def generate_with_metrics(
     If Ollama is unreachable or returns malformed JSON,
     we return {"text": "", "error": "..."}.
     """
-    base = _ollama_base_url().rstrip("/")
-    url = f"{base}/api/generate"
-
-    payload: Dict[str, Any] = {
-        "model": model or os.getenv("OLLAMA_MODEL", "llama3"),
-        "prompt": prompt,
-        "stream": True,  # ollama streams by default
-        "options": {
-            "num_predict": num_predict,
-        },
-    }
-    if stop:
-        payload["stop"] = stop
+    url = _ollama_cfg().generate_url
+    payload = _payload(prompt, model, num_predict, stop)
 
     try:
-        resp = requests.post(url, json=payload, stream=True, timeout=timeout_seconds)
+        resp = _session().post(url, json=payload, stream=True, timeout=timeout_seconds)
     except Exception as e:
-        print(f"[ollama_client] cannot connect to Ollama: {e}")
+        logger.warning("cannot connect to Ollama: %s", e)
         return {"text": "", "error": str(e)}
 
     if resp.status_code != 200:
         err = f"Ollama HTTP {resp.status_code}: {resp.text[:200]}"
-        print(f"[ollama_client] bad status: {err}")
+        logger.warning("bad status: %s", err)
         return {"text": "", "error": err}
 
-    full_text = []
-    total_duration_ms = 0
-    model_name = None
-    prompt_eval_count = 0
-    eval_count = 0
-
-    for line in resp.iter_lines(decode_unicode=True):
+    out = _StreamResult()
+    # orjson parses the raw bytes of each chunk; no per-line str decode
+    for line in resp.iter_lines():
         if not line:
             continue
         try:
-            obj = json.loads(line)
-        except json.JSONDecodeError as je:
+            obj = orjson.loads(line)
+        except orjson.JSONDecodeError as je:
             # this is the exact error you saw: "Extra data: line 2..."
             # we will not crash the whole app because of this
-            print(f"[ollama_client] JSON decode error on line: {je} | line={line!r}")
-            return {"text": "".join(full_text), "error": str(je)}
+            logger.warning("JSON decode error on line: %s | line=%r", je, line)
+            # drop the half-read stream instead of leaving it checked out of the pool
+            resp.close()
+            return out.partial(je)
+        out.add(obj)
 
-        # collect text
-        if "response" in obj and obj["response"]:
-            full_text.append(obj["response"])
+    return out.result()
 
-        # collect metrics if present
-        if "model" in obj and not model_name:
-            model_name = obj["model"]
-        if "total_duration" in obj:
-            total_duration_ms = int(obj["total_duration"] / 1_000_000)
-        if "prompt_eval_count" in obj:
-            prompt_eval_count = int(obj["prompt_eval_count"])
-        if "eval_count" in obj:
-            eval_count = int(obj["eval_count"])
-
-    final_text = "".join(full_text).strip()
-    return {
-        "text": final_text,
-        "model": model_name,
-        "total_duration_ms": total_duration_ms,
-        "prompt_eval_count": prompt_eval_count,
-        "eval_count": eval_count,
-    }
+
+async def agenerate_with_metrics(
+    prompt: str,
+    model: Optional[str] = None,
+    timeout_seconds: float = 12.0,
+    num_predict: int = 128,
+    stop: Optional[list[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Same contract as generate_with_metrics, but awaits Ollama without holding a worker thread.
+    """
+    url = _ollama_cfg().generate_url
+    payload = _payload(prompt, model, num_predict, stop)
+
+    try:
+        async with _async_client().stream("POST", url, json=payload, timeout=timeout_seconds) as resp:
+            if resp.status_code != 200:
+                body = (await resp.aread()).decode("utf-8", "replace")
+                err = f"Ollama HTTP {resp.status_code}: {body[:200]}"
+                logger.warning("bad status: %s", err)
+                return {"text": "", "error": err}
+
+            out = _StreamResult()
+            async for line in resp.aiter_lines():
+                if not line:
+                    continue
+                try:
+                    obj = orjson.loads(line)
+                except orjson.JSONDecodeError as je:
+                    logger.warning("JSON decode error on line: %s | line=%r", je, line)
+                    return out.partial(je)
+                out.add(obj)
+    except Exception as e:
+        # any failure (bad URL, transport, malformed stream) keeps the {"text", "error"} contract
+        logger.warning("cannot connect to Ollama: %s", e)
+        return {"text": "", "error": str(e)}
+
+    return out.result()
@@ -1,76 +1,96 @@
 import re
 
+# first number in the question, e.g. the threshold in "more than 5"
+_RX_NUM = re.compile(r"\d+")
+
+
+def _all_products(q: str) -> str:
+    return (
+        "SELECT [ProductCode],[ProductName],[Quantity],[Classification] "
+        "FROM [dbo].[products] ORDER BY [ProductName];"
+    )
+
+
+def _best_selling(q: str) -> str:
+    return (
+        "SELECT TOP 10 [p].[ProductCode],[p].[ProductName], "
+        "SUM([s].[QuantitySold]) AS [TotalSold] "
+        "FROM [dbo].[selling] AS [s] "
+        "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
+        "GROUP BY [p].[ProductCode],[p].[ProductName] "
+        "ORDER BY SUM([s].[QuantitySold]) DESC;"
+    )
+
+
+def _monthly_average(q: str) -> str:
+    m = _RX_NUM.search(q)
+    threshold = m.group(0) if m else "5"
+    return (
+        "SELECT [p].[ProductCode],[p].[ProductName], "
+        "AVG([s].[QuantitySold]) AS [AvgMonthlySales], "
+        "COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) AS [MonthsActive] "
+        "FROM [dbo].[selling] AS [s] "
+        "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
+        f"GROUP BY [p].[ProductCode],[p].[ProductName] "
+        f"HAVING AVG([s].[QuantitySold]) > {threshold} "
+        "ORDER BY [AvgMonthlySales] DESC;"
+    )
+
+
+def _distinct_months(q: str) -> str:
+    m = _RX_NUM.search(q)
+    threshold = m.group(0) if m else "5"
+    return (
+        "SELECT [p].[ProductCode],[p].[ProductName], "
+        "COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) AS [MonthsWithSales] "
+        "FROM [dbo].[selling] AS [s] "
+        "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
+        f"GROUP BY [p].[ProductCode],[p].[ProductName] "
+        f"HAVING COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) >= {threshold} "
+        "ORDER BY [MonthsWithSales] DESC;"
+    )
+
+
+def _bought_not_sold(q: str) -> str:
+    return (
+        "SELECT DISTINCT [p].[ProductCode],[p].[ProductName],[p].[Classification] "
+        "FROM [dbo].[buying] AS [b] "
+        "JOIN [dbo].[products] AS [p] ON [b].[ProductCode]=[p].[ProductCode] "
+        "WHERE [b].[ProductCode] NOT IN (SELECT DISTINCT [ProductCode] FROM [dbo].[selling]) "
+        "ORDER BY [p].[ProductName];"
+    )
+
+
+def _revenue(q: str) -> str:
+    return (
+        "SELECT [p].[ProductCode],[p].[ProductName], "
+        "SUM([s].[QuantitySold]) AS [TotalQuantity], "
+        "SUM([s].[QuantitySold]*[s].[SellingPrice]) AS [TotalRevenue] "
+        "FROM [dbo].[selling] AS [s] "
+        "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
+        "GROUP BY [p].[ProductCode],[p].[ProductName] "
+        "ORDER BY [TotalRevenue] DESC;"
+    )
+
+
 class PatternSQLGenerator:
     """
     High-precision patterns for common pharmacy analytics (Arabic/English).
     """
+    # (keywords, builder), checked in order; the first rule with a keyword in the question wins
+    PATTERNS = (
+        (("all products", "جميع المنتجات", "show products", "كل المنتجات"), _all_products),
+        (("best selling", "أكثر مبيع", "top selling", "most sold", "الأكثر مبيعاً"), _best_selling),
+        (("per month", "شهريا", "في الشهر", "monthly"), _monthly_average),
+        (("distinct months", "different months", "شهر مختلف"), _distinct_months),
+        (("purchased but never sold", "تم شراؤها ولكن لم تباع", "bought not sold"), _bought_not_sold),
+        (("revenue", "إجمالي الإيرادات", "total sales", "إجمالي المبيعات"), _revenue),
+    )
+
     @staticmethod
     def generate(question: str) -> str | None:
         q = (question or "").lower()
-
-        def has_any(words): return any(w in q for w in words)
-
-        if has_any(["all products", "جميع المنتجات", "show products", "كل المنتجات"]):
-            return (
-                "SELECT [ProductCode],[ProductName],[Quantity],[Classification] "
-                "FROM [dbo].[products] ORDER BY [ProductName];"
-            )
-
-        if has_any(["best selling", "أكثر مبيع", "top selling", "most sold", "الأكثر مبيعاً"]):
-            return (
-                "SELECT TOP 10 [p].[ProductCode],[p].[ProductName], "
-                "SUM([s].[QuantitySold]) AS [TotalSold] "
-                "FROM [dbo].[selling] AS [s] "
-                "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
-                "GROUP BY [p].[ProductCode],[p].[ProductName] "
-                "ORDER BY SUM([s].[QuantitySold]) DESC;"
-            )
-
-        if has_any(["per month", "شهريا", "في الشهر", "monthly"]):
-            nums = re.findall(r"\d+", q)
-            threshold = nums[0] if nums else "5"
-            return (
-                "SELECT [p].[ProductCode],[p].[ProductName], "
-                "AVG([s].[QuantitySold]) AS [AvgMonthlySales], "
-                "COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) AS [MonthsActive] "
-                "FROM [dbo].[selling] AS [s] "
-                "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
-                f"GROUP BY [p].[ProductCode],[p].[ProductName] "
-                f"HAVING AVG([s].[QuantitySold]) > {threshold} "
-                "ORDER BY [AvgMonthlySales] DESC;"
-            )
-
-        if has_any(["distinct months", "different months", "شهر مختلف"]):
-            nums = re.findall(r"\d+", q)
-            threshold = nums[0] if nums else "5"
-            return (
-                "SELECT [p].[ProductCode],[p].[ProductName], "
-                "COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) AS [MonthsWithSales] "
-                "FROM [dbo].[selling] AS [s] "
-                "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
-                f"GROUP BY [p].[ProductCode],[p].[ProductName] "
-                f"HAVING COUNT(DISTINCT FORMAT([s].[Date],'yyyy-MM')) >= {threshold} "
-                "ORDER BY [MonthsWithSales] DESC;"
-            )
-
-        if has_any(["purchased but never sold", "تم شراؤها ولكن لم تباع", "bought not sold"]):
-            return (
-                "SELECT DISTINCT [p].[ProductCode],[p].[ProductName],[p].[Classification] "
-                "FROM [dbo].[buying] AS [b] "
-                "JOIN [dbo].[products] AS [p] ON [b].[ProductCode]=[p].[ProductCode] "
-                "WHERE [b].[ProductCode] NOT IN (SELECT DISTINCT [ProductCode] FROM [dbo].[selling]) "
-                "ORDER BY [p].[ProductName];"
-            )
-
-        if has_any(["revenue", "إجمالي الإيرادات", "total sales", "إجمالي المبيعات"]):
-            return (
-                "SELECT [p].[ProductCode],[p].[ProductName], "
-                "SUM([s].[QuantitySold]) AS [TotalQuantity], "
-                "SUM([s].[QuantitySold]*[s].[SellingPrice]) AS [TotalRevenue] "
-                "FROM [dbo].[selling] AS [s] "
-                "JOIN [dbo].[products] AS [p] ON [s].[ProductCode]=[p].[ProductCode] "
-                "GROUP BY [p].[ProductCode],[p].[ProductName] "
-                "ORDER BY [TotalRevenue] DESC;"
-            )
-
+        for words, build in PatternSQLGenerator.PATTERNS:
+            if any(w in q for w in words):
+                return build(q)
         return None
@@ -0,0 +1,37 @@
+# app/services/pattern_matcher.py
+from __future__ import annotations
+
+import re
+from functools import lru_cache
+
+from app.services.pattern import PatternSQLGenerator
+
+
+class PatternMatcher:
+    """
+    Wraps PatternSQLGenerator with one compiled prefilter over every keyword,
+    so questions that cannot match any rule are rejected in a single scan.
+    """
+
+    def __init__(self, patterns=PatternSQLGenerator.PATTERNS) -> None:
+        self._patterns = patterns
+        words = sorted({w for ws, _ in patterns for w in ws}, key=len, reverse=True)
+        self._prefilter = re.compile("|".join(re.escape(w) for w in words))
+        # pure in the lower-cased question: repeated questions skip the scan
+        self._match = lru_cache(maxsize=256)(self._match_uncached)
+
+    def generate(self, question: str) -> str | None:
+        return self._match((question or "").lower())
+
+    def _match_uncached(self, q: str) -> str | None:
+        if not self._prefilter.search(q):
+            return None
+        for words, build in self._patterns:
+            if any(w in q for w in words):
+                return build(q)
+        return None
+
+
+@lru_cache(maxsize=None)
+def pattern_generator() -> PatternMatcher:
+    return PatternMatcher()
@@ -0,0 +1,28 @@
+# app/services/schema_cache.py
+from functools import lru_cache
+from typing import Dict, FrozenSet, Set
+
+from sqlalchemy import text
+
+from app.db.session import get_engine
+
+_SCHEMA_QUERY = """
+SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME
+FROM INFORMATION_SCHEMA.COLUMNS
+WHERE TABLE_SCHEMA='dbo' AND TABLE_NAME IN ('products','selling','buying');
+"""
+
+
+@lru_cache(maxsize=1)
+def load_schema() -> Dict[str, FrozenSet[str]]:
+    """
+    Columns of the 3 tables we care about, read once per process and shared by
+    the agents and langchain routes. Failures raise, so they are never cached.
+    """
+    with get_engine().connect() as conn:
+        rows = conn.execute(text(_SCHEMA_QUERY)).fetchall()
+    tables: Dict[str, Set[str]] = {"products": set(), "selling": set(), "buying": set()}
+    for sch, tn, col in rows:
+        tables[tn.lower()].add(col)
+    # frozen so column sets can key the _best_match cache
+    return {tn: frozenset(cols) for tn, cols in tables.items()}
@@ -0,0 +1,343 @@
+# app/services/sql_sanitizer.py
+# SQL clean-up shared by the agents and langchain routes
+from __future__ import annotations
+
+import difflib
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+
+from app.core.config import settings
+
+# optional C++ fuzzy matcher; difflib is used when it is not installed
+try:
+    from rapidfuzz import fuzz as _rf_fuzz
+except Exception:
+    _rf_fuzz = None  # type: ignore
+
+# reply wrappers extract_sql_any looks for, most specific first
+_TAG_BLOCK = re.compile(r"<SQL>\s*([\s\S]+?)\s*</SQL>", re.IGNORECASE)
+_TRIPLE_SQL = re.compile(r"```sql\s*([\s\S]+?)```", re.IGNORECASE)
+_TRIPLE_ANY = re.compile(r"```\s*([\s\S]+?)```", re.IGNORECASE)
+_SQLQUERY_LINE = re.compile(r"SQLQuery:\s*(SELECT[\s\S]+?;)", re.IGNORECASE)
+_FIRST_SELECT_SEMI = re.compile(r"(SELECT[\s\S]+?;)", re.IGNORECASE)
+_FIRST_WITH_BLOCK = re.compile(r"((?:;?\s*WITH|WITH)\s+[\s\S]+?SELECT[\s\S]+?;)", re.IGNORECASE)
+
+_ALIAS_TABLE = {"p": "products", "s": "selling", "b": "buying"}
+_BOUNDARY = r"(?=(?:AND|OR|GROUP\s+BY|ORDER\s+BY|HAVING|JOIN|UNION|;|$))"
+
+# misspelled column -> real column; applied as "<alias>.<col>" first, then as a bare token
+_COMMON_SYNONYMS = {
+    "quantityselling": "QuantitySold",
+    "buyingprice": "CostBuying",
+    "manufacturerprice": "ManufacturerCost",
+    "productprice": "ProductSellingPrice",
+}
+_COMMON_TOKENS = {
+    "quantityselling": "QuantitySold",
+    "buyingprice": "CostBuying",
+    "manufacturerprice": "ManufacturerCost",
+    "productprice": "ProductSellingPrice",
+    "averageselingprice": "AverageSellingPrice",
+}
+_SYNONYM_NAMES = "QuantitySelling|BuyingPrice|ManufacturerPrice|ProductPrice"
+_RX_SYNONYMS = re.compile(rf"\b([psb])\.\[?({_SYNONYM_NAMES})\]?\b", re.IGNORECASE)
+# "b.[BuyingPrice]WITH": the renamed column runs into the next word
+_RX_SYNONYM_GLUED = re.compile(rf"\b[psb]\.\[?(?:{_SYNONYM_NAMES})\]\w", re.IGNORECASE)
+_RX_TOKENS = re.compile(
+    r"\b(QuantitySelling|BuyingPrice|ManufacturerPrice|ProductPrice|AverageSelingPrice)\b", re.IGNORECASE
+)
+# non-ASCII letters re.IGNORECASE treats as equal to ASCII ones; folded before dict lookups
+_FOLD = str.maketrans({"\u0130": "i", "\u0131": "i", "\u017f": "s", "\u212a": "k"})
+
+
+def fold(word: str) -> str:
+    return word.translate(_FOLD).lower()
+
+
+def folded(sql: str) -> str:
+    """
+    Lower-cased text for cheap substring prefilters (keyword in folded(sql)).
+    """
+    return sql.lower() if sql.isascii() else fold(sql)
+
+
+_RX_SQL_LABEL = re.compile(r"^\s*\[?SQL\]?\s*:\s*", re.IGNORECASE)
+_RX_QUOTE_ANDOR = re.compile(r"'\s*(AND|OR)\b", re.IGNORECASE)
+_RX_GETDATE_MINUS = re.compile(r"GETDATE\(\s*-\s*(\d+)\s*\)", re.IGNORECASE)
+_RX_TRAILING_QUOTE_SEMI = re.compile(r"['\"]\s*;$")
+
+_RX_TABLES = re.compile(r"\b(FROM|JOIN)\s+\[?(Products|Selling|Buying)\]?\b", re.IGNORECASE)
+
+_RX_ALIAS_COL = re.compile(r"\b([psb])\.\[?([A-Za-z_]\w*)\]?\b")
+# one pass for _schema_correct_alias_columns: alias synonym | alias column | bare token
+_RX_COLUMN_FIX = re.compile(
+    "(?i:" + _RX_SYNONYMS.pattern + ")|" + _RX_ALIAS_COL.pattern + "|(?i:" + _RX_TOKENS.pattern + ")"
+)
+
+_RX_DATE_CMP_INCOMPLETE = re.compile(
+    rf"(\b[psb]\.\[?Date\]?|\bDate\b)\s*(<=|<|>=|>|=)\s*{_BOUNDARY}", re.IGNORECASE
+)
+_RX_DATE_BETWEEN_INCOMPLETE = re.compile(
+    rf"(\b[psb]\.\[?Date\]?|\bDate\b)\s+BETWEEN\s+([^\s]+)\s+AND\s*{_BOUNDARY}", re.IGNORECASE
+)
+# (?<!\s): start only at the head of a whitespace run; retrying from every space
+# in the run was quadratic in its length (seconds on a few thousand spaces)
+_RX_DANGLING_ANDOR = re.compile(rf"(?<!\s)\s+\b(AND|OR)\b\s*{_BOUNDARY}", re.IGNORECASE)
+# the three above as one alternation, so _fix_incomplete_predicates scans once.
+# A completed date predicate also swallows an AND/OR left dangling right after it,
+# which the separate dangling pass used to remove from the rewritten text.
+_DANGLING_TAIL = rf"(?:\b(?:AND|OR)\b\s*{_BOUNDARY})?"
+_RX_INCOMPLETE = re.compile(
+    f"(?:{_RX_DATE_CMP_INCOMPLETE.pattern}{_DANGLING_TAIL})"
+    f"|(?:{_RX_DATE_BETWEEN_INCOMPLETE.pattern}{_DANGLING_TAIL})"
+    f"|(?:{_RX_DANGLING_ANDOR.pattern})",
+    re.IGNORECASE,
+)
+
+_RX_STARTS_SELECT = re.compile(r"^\s*select\b", re.IGNORECASE)
+_RX_TOP_INJECT = re.compile(r"^select\s+", re.IGNORECASE)
+# injected row cap: never more than the preview the routes fetch
+_TOP_INJECT = f"SELECT TOP {min(200, settings.preview_limit)} "
+
+# needs_cleanup runs the fix patterns one by one behind substring guards: one
+# fused alternation was slower than the whole sanitize pass on clean SQL
+_RX_NEEDS_ALIAS_COL = re.compile(_RX_ALIAS_COL.pattern, re.IGNORECASE)
+# folded text lacking all of these cannot match an alias-column pattern
+_ALIAS_DOTS = ("p.", "s.", "b.")
+
+
+def _basic_cleanup(sql: str, reply_fixes: bool) -> str:
+    s = (sql or "").strip()
+    if reply_fixes:
+        s = _RX_SQL_LABEL.sub("", s)
+    s = s.replace("`", "'")
+    if "'" in s:
+        s = _RX_QUOTE_ANDOR.sub(r"' \1", s)
+    if "getdate" in folded(s):
+        s = _RX_GETDATE_MINUS.sub(r"DATEADD(day, -\1, GETDATE())", s)
+    # same as _RX_TRAILING_QUOTE_SEMI.sub(";", s) on stripped text
+    if reply_fixes and s.endswith(";"):
+        body = s[:-1].rstrip()
+        if body.endswith(("'", '"')):
+            s = body[:-1] + ";"
+    return s
+
+
+def _table_repl(m: re.Match) -> str:
+    # fold, not upper()/lower(): the match may hold non-ASCII case variants
+    return f"{fold(m.group(1)).upper()} [dbo].[{fold(m.group(2))}]"
+
+
+def _normalize_tables(sql: str) -> str:
+    low = folded(sql)
+    if "from" not in low and "join" not in low:
+        return sql
+    return _RX_TABLES.sub(_table_repl, sql)
+
+
+_MATCH_CUTOFF = 0.65
+
+
+@lru_cache(maxsize=64)
+def _lower_index(candidates: FrozenSet[str]) -> Dict[str, str]:
+    return {c.lower(): c for c in candidates}
+
+
+@lru_cache(maxsize=1024)
+def _best_match(name: str, candidates: FrozenSet[str]) -> Optional[str]:
+    exact = _lower_index(candidates).get(name.lower())
+    if exact is not None:
+        return exact
+    # difflib's ratio is at most 2*min(len)/(sum of lens): drop candidates that cannot reach the cutoff
+    n = len(name)
+    close = [c for c in candidates if 2 * min(n, len(c)) >= _MATCH_CUTOFF * (n + len(c))]
+    if _rf_fuzz is not None:
+        # best (score, name), the same tie-break get_close_matches uses
+        best = max(((_rf_fuzz.ratio(name, c), c) for c in close), default=None)
+        return best[1] if best and best[0] / 100 >= _MATCH_CUTOFF else None
+    matches = difflib.get_close_matches(name, close, n=1, cutoff=_MATCH_CUTOFF)
+    return matches[0] if matches else None
+
+
+def _schema_correct_alias_columns(sql: str, tables: Dict[str, FrozenSet[str]]) -> Tuple[str, int]:
+    low = folded(sql)
+    if not any(d in low for d in _ALIAS_DOTS) and not any(w in low for w in _COMMON_TOKENS):
+        # no "<alias>." and no misspelled token: _RX_COLUMN_FIX cannot match
+        return sql, 0
+    fixed_synonyms: Set[str] = set()
+    fixes = 0
+    alias_table = _ALIAS_TABLE
+
+    if _RX_SYNONYM_GLUED.search(sql):
+        # rename in a pass of its own first, so the column check below sees the
+        # renamed column together with the word it now runs into
+        def rename(m: re.Match) -> str:
+            key = fold(m.group(2))
+            fixed_synonyms.add(key)
+            return f"{m.group(1)}.{_COMMON_SYNONYMS[key]}"
+
+        sql = _RX_SYNONYMS.sub(rename, sql)
+
+    def check(alias: str, col: str) -> Optional[str]:
+        nonlocal fixes
+        table = alias_table.get(alias)
+        valid = tables.get(table, frozenset()) if table else frozenset()
+        if col in valid or not valid:
+            return None
+        sug = _best_match(col, valid)
+        if sug:
+            fixes += 1
+            return f"{alias}.{sug}"
+        return None
+
+    def repl(m: re.Match) -> str:
+        if m.group(2) is not None:
+            # "<alias>.<synonym>": rename, then schema-check the real name
+            alias = m.group(1)
+            key = fold(m.group(2))
+            fixed_synonyms.add(key)
+            col = _COMMON_SYNONYMS[key]
+            return check(alias, col) or f"{alias}.{col}"
+        if m.group(4) is not None:
+            # "<alias>.<col>": bare-token rename (if any), then schema check
+            alias, col = m.group(3), m.group(4)
+            renamed = _COMMON_TOKENS.get(fold(col))
+            if renamed:
+                col = renamed
+            fixed = check(alias, col)
+            if fixed:
+                return fixed
+            if not renamed:
+                return m.group(0)
+            return sql[m.start(): m.start(4)] + col + sql[m.end(4): m.end()]
+        return _COMMON_TOKENS[fold(m.group(5))]
+
+    s = _RX_COLUMN_FIX.sub(repl, sql)
+    # one fix per distinct synonym, as when each synonym had its own pass
+    return s, fixes + len(fixed_synonyms)
+
+
+def _incomplete_repl(m: re.Match) -> str:
+    if m.group(1) is not None:
+        return f"{m.group(1)} {m.group(2)} GETDATE() "
+    if m.group(3) is not None:
+        return f"{m.group(3)} BETWEEN {m.group(4)} AND GETDATE() "
+    return " "
+
+
+def _fix_incomplete_predicates(sql: str) -> str:
+    if "date" not in folded(sql):
+        # neither date alternative can match: only dangling AND/OR is left
+        return _RX_DANGLING_ANDOR.sub(" ", sql)
+    return _RX_INCOMPLETE.sub(_incomplete_repl, sql)
+
+
+def starts_with_select(sql: str) -> bool:
+    head = sql.lstrip()[:7]
+    if not head.isascii():
+        # non-ASCII letters can case-fold onto ASCII; let the regex decide
+        return _RX_STARTS_SELECT.match(sql) is not None
+    return head[:6].lower() == "select" and not (head[6:7].isalnum() or head[6:7] == "_")
+
+
+def needs_cleanup(sql: str) -> bool:
+    """
+    False when none of the text fixes in sanitize_sql (reply_fixes included) would
+    change the SQL; the TOP and trailing ';' checks are left to the caller.
+    """
+    if "`" in sql or _RX_SQL_LABEL.search(sql):
+        return True
+    # folded: the guards must see what the IGNORECASE patterns would match
+    low = folded(sql)
+    if "'" in sql and _RX_QUOTE_ANDOR.search(sql):
+        return True
+    if ("'" in sql or '"' in sql) and _RX_TRAILING_QUOTE_SEMI.search(sql):
+        return True
+    if "getdate" in low and _RX_GETDATE_MINUS.search(sql):
+        return True
+    if any(w in low for w in _COMMON_TOKENS) and _RX_TOKENS.search(sql):
+        return True
+    if any(d in low for d in _ALIAS_DOTS) and _RX_NEEDS_ALIAS_COL.search(sql):
+        return True
+    if "date" in low and (
+        _RX_DATE_CMP_INCOMPLETE.search(sql) or _RX_DATE_BETWEEN_INCOMPLETE.search(sql)
+    ):
+        return True
+    return _RX_TABLES.search(sql) is not None or _RX_DANGLING_ANDOR.search(sql) is not None
+
+
+def is_canonical(sql: str, low: Optional[str] = None) -> bool:
+    """
+    True when sanitize_sql (either mode) would return `sql` unchanged and it already
+    ends with ';'. `low` is sql.lower() when the caller has it.
+    """
+    if not sql or not sql.endswith(";") or sql != sql.strip():
+        return False
+    if starts_with_select(sql) and " top " not in (low if low is not None else sql.lower()):
+        return False
+    return not needs_cleanup(sql)
+
+
+def inject_top(sql: str) -> str:
+    if starts_with_select(sql) and " top " not in sql.lower():
+        return _RX_TOP_INJECT.sub(_TOP_INJECT, sql, count=1)
+    return sql
+
+
+def sanitize_sql(sql: str, tables: Dict[str, FrozenSet[str]], reply_fixes: bool = False) -> str:
+    """
+    Text fixes, [dbo] table names, completed predicates, schema-checked columns
+    (skipped when `tables` is empty) and the TOP cap. `reply_fixes` also drops a
+    leading "SQL:" label and a quote left before the final ';' (agents route).
+    Route-specific steps and the closing ';' are up to the caller.
+    """
+    s = _basic_cleanup(sql, reply_fixes)
+    s = _normalize_tables(s)
+    s = _fix_incomplete_predicates(s)
+    s, _ = _schema_correct_alias_columns(s, tables)
+    return inject_top(s)
+
+
+def extract_sql_any(text_: str) -> Optional[str]:
+    """
+    The SQL statement in an LLM reply: <SQL> tags, fenced blocks, "SQLQuery:",
+    then the first SELECT/WITH; None when there is none.
+    """
+    if not text_:
+        return None
+    t = text_.strip()
+    # the writer prompt asks for <SQL> tags: when the reply opens with one, skip the guards
+    if t[:5].upper() == "<SQL>":
+        m = _TAG_BLOCK.search(t)
+        if m:
+            return m.group(1).strip()
+    # cheap substring guards: only run a regex when its literal marker is present
+    low = folded(t)
+    has_select = "select" in low
+    candidates = []
+    if "<sql>" in low and "</sql>" in low:
+        candidates.append(_TAG_BLOCK)
+    if low.count("```") >= 2:
+        if "```sql" in low:
+            candidates.append(_TRIPLE_SQL)
+        candidates.append(_TRIPLE_ANY)
+    if has_select:
+        # the lazy "...?;" patterns go quadratic on output with no ';' at all
+        # (e.g. cut off by num_predict), so they only run when one exists
+        if ";" in t:
+            if "sqlquery:" in low:
+                candidates.append(_SQLQUERY_LINE)
+            candidates.append(_FIRST_SELECT_SEMI)
+            if "with" in low:
+                candidates.append(_FIRST_WITH_BLOCK)
+    for rx in candidates:
+        m = rx.search(t)
+        if m:
+            return m.group(1).strip()
+    if has_select:
+        # last resort: everything from the first SELECT on (folding keeps offsets aligned)
+        i = low.find("select")
+        if i + 6 < len(t):
+            return t[i:].strip()
+    return None
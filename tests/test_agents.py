@@ -0,0 +1,28 @@
+import threading
+
+from app.services import agents
+
+
+def test_discarded_speculative_plan_does_not_add_metrics(monkeypatch):
+    release_planner = threading.Event()
+    planner_done = threading.Event()
+
+    def fake_llm(prompt, **kwargs):
+        if prompt.startswith("You are a BI planner"):
+            release_planner.wait(5)
+            planner_done.set()
+            return {"text": "plan", "model": "m", "prompt_eval_count": 1000, "eval_count": 1000}
+        return {"text": "<SQL>SELECT [p].[ProductName] FROM [dbo].[products] AS [p];</SQL>",
+                "model": "m", "prompt_eval_count": 3, "eval_count": 4}
+
+    monkeypatch.setattr(agents, "generate_with_metrics", fake_llm)
+    monkeypatch.setattr(agents, "_load_schema", lambda: {})
+    orch = agents.AgentOrchestrator()
+
+    plan, sql = orch._plan_and_write_speculative("list products", agents.time.perf_counter())
+    assert plan is None and "[dbo].[products]" in sql
+
+    # the planner finishes after its result was discarded
+    release_planner.set()
+    assert planner_done.wait(5)
+    assert (orch.metrics["prompt_tokens"], orch.metrics["eval_tokens"]) == (3, 4)
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.services import langchain_sql
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """
+    Stub the chain, Ollama and the DB; record which thread ran each blocking call.
+    The first query fails so the repair branch runs.
+    """
+    calls = []
+
+    def blocking(name, result):
+        def fn(*args, **kwargs):
+            calls.append((name, threading.current_thread() is threading.main_thread()))
+            if isinstance(result, Exception):
+                raise result
+            return result(*args) if callable(result) else result
+        return fn
+
+    queries = []
+
+    def fetch(sql, limit):
+        # every first query of a run fails; the repaired one succeeds
+        queries.append(sql)
+        if len(queries) % 2:
+            raise RuntimeError("Invalid column name")
+        return ["ProductName"], [{"ProductName": "x"}]
+
+    reply = {"text": "<SQL>SELECT ProductName FROM dbo.products;</SQL>", "model": "m",
+             "prompt_eval_count": 3, "eval_count": 4, "total_duration_ms": 5}
+
+    async def agen(prompt, **kwargs):
+        return reply
+
+    monkeypatch.setattr(langchain_sql, "_run_chain", blocking("chain", lambda q: (None, 0)))
+    monkeypatch.setattr(langchain_sql, "_ollama_prompt", blocking("prompt", lambda q: "p"))
+    monkeypatch.setattr(langchain_sql, "_repair_prompt", blocking("repair", lambda e, s: "r"))
+    monkeypatch.setattr(langchain_sql, "_sql_from_reply", blocking("extract", lambda t: "SELECT 1;"))
+    monkeypatch.setattr(langchain_sql, "fetch_rows", blocking("fetch", fetch))
+    monkeypatch.setattr(langchain_sql, "generate_with_metrics", lambda prompt, **kw: reply)
+    monkeypatch.setattr(langchain_sql, "agenerate_with_metrics", agen)
+    return calls
+
+
+def _strip_timing(result):
+    return {k: v for k, v in result.items() if k != "total_ms"}
+
+
+def test_sync_and_async_pipelines_agree(pipeline):
+    sync = langchain_sql.generate_and_execute("q", 10)
+    sync_calls = [name for name, _ in pipeline]
+    pipeline.clear()
+    async_result = asyncio.run(langchain_sql.agenerate_and_execute("q", 10))
+    assert [name for name, _ in pipeline] == sync_calls
+    assert "repair" in sync_calls
+    assert _strip_timing(async_result) == _strip_timing(sync)
+    assert sync["llm_total_tokens"] == 14
+
+
+def test_async_pipeline_runs_blocking_calls_off_the_event_loop(pipeline):
+    asyncio.run(langchain_sql.agenerate_and_execute("q", 10))
+    assert pipeline and not any(on_main for _, on_main in pipeline)
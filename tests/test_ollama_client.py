@@ -0,0 +1,32 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from app.services import ollama_client
+
+
+@pytest.fixture
+def generate_url(monkeypatch):
+    def use(url):
+        cfg = SimpleNamespace(**{**vars(ollama_client._ollama_cfg()), "generate_url": url})
+        monkeypatch.setattr(ollama_client, "_ollama_cfg", lambda: cfg)
+    return use
+
+
+@pytest.mark.parametrize("url", ["http://[::1", "http://a:b:c/api/generate"])
+def test_async_generate_returns_error_dict_for_invalid_url(generate_url, url):
+    generate_url(url)
+    out = asyncio.run(ollama_client.agenerate_with_metrics("ping", timeout_seconds=1))
+    assert out["text"] == ""
+    assert out["error"]
+
+
+def test_async_generate_returns_error_dict_for_malformed_stream(generate_url, monkeypatch):
+    generate_url("http://ollama.test/api/generate")
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=b'{"total_duration": "soon"}\n'))
+    monkeypatch.setattr(ollama_client, "_async_client", lambda: httpx.AsyncClient(transport=transport))
+    out = asyncio.run(ollama_client.agenerate_with_metrics("ping", timeout_seconds=1))
+    assert out["text"] == ""
+    assert out["error"]
@@ -0,0 +1,65 @@
+import orjson
+import pytest
+
+from app.routers.query import _extract_requested_top, _inject_top, _iter_ndjson
+
+
+@pytest.mark.parametrize(
+    "sql, expected",
+    [
+        ("SELECT TOP 5 * FROM dbo.Sales;", 5),
+        ("select distinct top 10 p.Name FROM dbo.Products p;", 10),
+        ("SELECT * FROM dbo.Sales;", None),
+        ("SELECT [Stop] FROM dbo.Sales;", None),
+        # upper() lengthens these, so offsets into the upper-cased head drift
+        ("SELECT TOP 7 N'ß' AS x;", 7),
+        ("SELECT N'ßßß' AS x, TOP 12 FROM t;", 12),
+        ("SELECT N'ﬁﬁﬁﬁ' AS ﬁ, TOP 3 FROM t;", 3),
+    ],
+)
+def test_extract_requested_top(sql, expected):
+    assert _extract_requested_top(sql) == expected
+
+
+@pytest.mark.parametrize(
+    "sql, expected",
+    [
+        ("SELECT a FROM t;", "SELECT TOP 50 a FROM t;"),
+        ("SELECT DISTINCT a FROM t;", "SELECT DISTINCT TOP 50 a FROM t;"),
+        ("SELECT ALL a FROM t;", "SELECT ALL TOP 50 a FROM t;"),
+        ("select all a FROM t;", "SELECT all TOP 50 a FROM t;"),
+        ("SELECT TOP 5 a FROM t;", "SELECT TOP 5 a FROM t;"),
+        # a head TOP would only limit the first branch
+        ("SELECT a FROM t UNION ALL SELECT a FROM u ORDER BY a;", None),
+        ("SELECT a FROM t INTERSECT SELECT a FROM u;", None),
+        ("SELECT a FROM t EXCEPT SELECT a FROM u;", None),
+        # TOP cannot be combined with OFFSET/FETCH
+        ("SELECT a FROM t ORDER BY a OFFSET 10 ROWS FETCH NEXT 5 ROWS ONLY;", None),
+        ("SELECT a FROM t ORDER BY a OFFSET 10 ROWS;", None),
+        ("WITH x AS (SELECT a FROM t) SELECT a FROM x;", None),
+    ],
+)
+def test_inject_top(sql, expected):
+    assert _inject_top(sql, 50) == (expected or sql)
+
+
+class _Closable:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _FailingResult(_Closable):
+    def mappings(self):
+        yield {"a": 1}
+        yield {"a": 2}
+        raise RuntimeError("connection lost")
+
+
+def test_iter_ndjson_ends_with_error_line_when_stream_fails():
+    conn, res = _Closable(), _FailingResult()
+    lines = [orjson.loads(line) for line in _iter_ndjson(conn, res, 100)]
+    assert lines[:2] == [{"a": 1}, {"a": 2}]
+    assert len(lines) == 3 and "connection lost" in lines[2]["error"]
+    assert res.closed and conn.closed
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from app.utils.sql_safety import _MAX_SQL_CHARS, enforce_select_only
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT 'Drop-in' AS name FROM dbo.Products;",
+        "SELECT 'it''s a DROP' AS x;",
+        'SELECT "Update" FROM dbo.Sales;',
+        'SELECT "say ""delete""" FROM dbo.Sales;',
+        "SELECT [Update] FROM dbo.Sales;",
+        "SELECT [a]]DROP] FROM dbo.Sales;",
+        "SELECT 1 -- drop it later\nFROM dbo.Sales;",
+        "SELECT 1 -- drop it later\r\nFROM dbo.Sales;",
+    ],
+)
+def test_keywords_inside_literals_and_comments_are_accepted(sql):
+    assert enforce_select_only(sql) == sql
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT 1 AS a DROP TABLE dbo.Sales;",
+        "SELECT 'x' AS a DELETE FROM dbo.Sales;",
+        "SELECT [x] AS a EXEC sp_who;",
+        "SELECT 1 -- note\nDROP TABLE dbo.Sales;",
+        # unterminated delimiters do not hide what follows them
+        "SELECT 'x DROP TABLE dbo.Sales;",
+        'SELECT "x DROP TABLE dbo.Sales;',
+        "SELECT [x DROP TABLE dbo.Sales;",
+        "SELECT 'it''s DROP TABLE dbo.Sales;",
+        "SELECT [a]] DROP TABLE dbo.Sales;",
+        # block comments fall back to checking every word
+        "SELECT /* drop */ 1;",
+        "SELECT /* /* */ 'x */ DROP TABLE dbo.Sales; --';",
+    ],
+)
+def test_blocked_keywords_are_rejected(sql):
+    with pytest.raises(ValueError, match="Only SELECT/CTE"):
+        enforce_select_only(sql)
+
+
+def test_line_comment_with_lone_cr_is_checked_word_by_word():
+    # a lexer ending "--" at "\r" would read the rest as one string literal
+    sql = "SELECT 1 AS a --x\r'\nDROP TABLE t --'"
+    with pytest.raises(ValueError, match="Only SELECT/CTE"):
+        enforce_select_only(sql)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT " + "[" * 60_000 + " DROP",
+        "SELECT " + "'" + "''" * 30_000 + " DROP",
+        "SELECT " + "[a]]" * 15_000 + " DROP",
+        "SELECT " + "-- x\r" * 12_000 + " DROP",
+    ],
+)
+def test_blocked_keyword_scan_is_linear(sql):
+    assert len(sql) <= _MAX_SQL_CHARS
+    start = time.perf_counter()
+    with pytest.raises(ValueError):
+        enforce_select_only(sql)
+    assert time.perf_counter() - start < 0.5
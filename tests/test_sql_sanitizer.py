@@ -0,0 +1,239 @@
+import difflib
+import random
+import re
+
+import pytest
+
+from app.services import sql_sanitizer
+from app.services.sql_sanitizer import (
+    _best_match,
+    extract_sql_any,
+    inject_top,
+    is_canonical,
+    needs_cleanup,
+    sanitize_sql,
+)
+
+TABLES = {
+    "products": frozenset({"ProductCode", "ProductName", "Quantity", "Classification", "ProductSellingPrice"}),
+    "selling": frozenset({"SellingID", "ProductCode", "Date", "Store", "QuantitySold", "SellingPrice",
+                          "ManufacturerCost", "AverageSellingPrice"}),
+    "buying": frozenset({"ProductCode", "NetQuantity", "QuantityBuying", "NetCost", "CostBuying"}),
+}
+
+# --- reference: the straightforward per-route implementations this module replaced ---
+
+_BOUNDARY = r"(?=(?:AND|OR|GROUP\s+BY|ORDER\s+BY|HAVING|JOIN|UNION|;|$))"
+_REF_SYNONYMS = {
+    r"\b([psb])\.\[?QuantitySelling\]?\b": r"\1.QuantitySold",
+    r"\b([psb])\.\[?BuyingPrice\]?\b": r"\1.CostBuying",
+    r"\b([psb])\.\[?ManufacturerPrice\]?\b": r"\1.ManufacturerCost",
+    r"\b([psb])\.\[?ProductPrice\]?\b": r"\1.ProductSellingPrice",
+}
+_REF_TOKENS = {
+    r"\bQuantitySelling\b": "QuantitySold",
+    r"\bBuyingPrice\b": "CostBuying",
+    r"\bManufacturerPrice\b": "ManufacturerCost",
+    r"\bProductPrice\b": "ProductSellingPrice",
+    r"\bAverageSelingPrice\b": "AverageSellingPrice",
+}
+
+
+def _ref_best_match(name, candidates):
+    nm = name.lower()
+    for c in candidates:
+        if c.lower() == nm:
+            return c
+    matches = difflib.get_close_matches(name, list(candidates), n=1, cutoff=0.65)
+    return matches[0] if matches else None
+
+
+def _ref_sanitize(sql, tables, reply_fixes):
+    s = (sql or "").strip()
+    if reply_fixes:
+        s = re.sub(r"^\s*\[?SQL\]?\s*:\s*", "", s, flags=re.IGNORECASE)
+    s = s.replace("`", "'")
+    s = re.sub(r"'\s*(AND|OR)\b", r"' \1", s, flags=re.IGNORECASE)
+    s = re.sub(r"GETDATE\(\s*-\s*(\d+)\s*\)", r"DATEADD(day, -\1, GETDATE())", s, flags=re.IGNORECASE)
+    if reply_fixes:
+        s = re.sub(r"['\"]\s*;$", ";", s)
+    for kw in ("FROM", "JOIN"):
+        for t in ("Products", "Selling", "Buying"):
+            s = re.sub(rf"\b{kw}\s+\[?{t}\]?\b", f"{kw} [dbo].[{t.lower()}]", s, flags=re.IGNORECASE)
+    s = re.sub(rf"(\b[psb]\.\[?Date\]?|\bDate\b)\s*(<=|<|>=|>|=)\s*{_BOUNDARY}",
+               r"\1 \2 GETDATE() ", s, flags=re.IGNORECASE)
+    s = re.sub(rf"(\b[psb]\.\[?Date\]?|\bDate\b)\s+BETWEEN\s+([^\s]+)\s+AND\s*{_BOUNDARY}",
+               r"\1 BETWEEN \2 AND GETDATE() ", s, flags=re.IGNORECASE)
+    s = re.sub(rf"\s+\b(AND|OR)\b\s*{_BOUNDARY}", " ", s, flags=re.IGNORECASE)
+    for pat, rep in _REF_SYNONYMS.items():
+        s = re.sub(pat, rep, s, flags=re.IGNORECASE)
+    for pat, rep in _REF_TOKENS.items():
+        s = re.sub(pat, rep, s, flags=re.IGNORECASE)
+
+    def repl(m):
+        alias, col = m.group(1), m.group(2)
+        valid = tables.get(sql_sanitizer._ALIAS_TABLE[alias], set())
+        if col in valid or not valid:
+            return m.group(0)
+        sug = _ref_best_match(col, valid)
+        return f"{alias}.{sug}" if sug else m.group(0)
+
+    s = re.sub(r"\b([psb])\.\[?([A-Za-z_]\w*)\]?\b", repl, s)
+    if re.match(r"^\s*select\b", s, flags=re.IGNORECASE) and " top " not in s.lower():
+        s = re.sub(r"(?i)^select\s+", sql_sanitizer._TOP_INJECT, s, count=1)
+    return s
+
+
+def _ref_extract(text_):
+    if not text_:
+        return None
+    t = text_.strip()
+    for rx in (
+        r"<SQL>\s*([\s\S]+?)\s*</SQL>",
+        r"```sql\s*([\s\S]+?)```",
+        r"```\s*([\s\S]+?)```",
+        r"SQLQuery:\s*(SELECT[\s\S]+?;)",
+        r"(SELECT[\s\S]+?;)",
+        r"((?:;?\s*WITH|WITH)\s+[\s\S]+?SELECT[\s\S]+?;)",
+        r"(SELECT[\s\S]+)$",
+    ):
+        m = re.search(rx, t, flags=re.IGNORECASE)
+        if m:
+            return m.group(1).strip()
+    return None
+
+
+# --- generated inputs: SQL-ish fragments, LLM reply wrappers and case-folding letters ---
+
+_PIECES = [
+    "SELECT", "select", "SELECT TOP 5", "DISTINCT", "*", ",", "(", ")", ";", "'", '"', "`",
+    "FROM", "JOIN", "ON", "WHERE", "AND", "OR", "GROUP BY", "ORDER BY", "HAVING", "UNION",
+    "Products", "[Selling]", "buying", "[dbo].[products] AS p", "p", "s", "b",
+    "p.ProductName", "p.[ProdName]", "s.Date", "s.[Date]", "Date", "date", ">=", "<", "=",
+    "BETWEEN", "'2024-01-01'", "GETDATE(-30)", "GETDATE()", "SUM(s.QuantitySold)",
+    "s.QuantitySelling", "b.[BuyingPrice]", "ManufacturerPrice", "AverageSelingPrice",
+    "s.Qty", "b.NetCst", "p.ProductPrice", "x.Date", "SQL:", "[SQL]:", "SQLQuery:",
+    "<SQL>", "</SQL>", "```sql", "```", "WITH t AS (", "note", "\n", "  ",
+    "ſelect", "K", "İ", "ı", "Datı",
+]
+
+
+def _inputs(seed, n):
+    rng = random.Random(seed)
+    for _ in range(n):
+        parts = rng.choices(_PIECES, k=rng.randint(1, 14))
+        yield "".join(p + rng.choice((" ", " ", "", "\n")) for p in parts)
+
+
+def _canonical_inputs(seed, n):
+    for s in _inputs(seed, n):
+        s = s.strip()
+        yield s if s.endswith(";") else s + ";"
+
+
+# --- tests ---
+
+
+@pytest.mark.parametrize("reply_fixes", [False, True])
+def test_sanitize_sql_matches_reference(reply_fixes):
+    for s in _inputs(1, 4000):
+        for tables in (TABLES, {}):
+            assert sanitize_sql(s, tables, reply_fixes) == _ref_sanitize(s, tables, reply_fixes), s
+
+
+def test_extract_sql_any_matches_reference():
+    for s in _inputs(2, 4000):
+        assert extract_sql_any(s) == _ref_extract(s), s
+
+
+@pytest.mark.parametrize(
+    "text_, expected",
+    [
+        ("<SQL>\nSELECT 1;\n</SQL>", "SELECT 1;"),
+        ("Here:\n```sql\nSELECT a FROM t;\n```", "SELECT a FROM t;"),
+        ("SQLQuery: SELECT a FROM t; -- done", "SELECT a FROM t;"),
+        ("WITH x AS (SELECT 1 AS a) SELECT a FROM x;", "SELECT 1 AS a) SELECT a FROM x;"),
+        ("the answer is SELECT a FROM t", "SELECT a FROM t"),
+        ("no sql here", None),
+        ("ends in select", None),
+        ("", None),
+    ],
+)
+def test_extract_sql_any(text_, expected):
+    assert extract_sql_any(text_) == expected
+
+
+def test_best_match_matches_difflib(monkeypatch):
+    # the length prefilter must not change difflib's answer
+    monkeypatch.setattr(sql_sanitizer, "_rf_fuzz", None)
+    rng = random.Random(3)
+    names = sorted(set().union(*TABLES.values()))
+    for _ in range(3000):
+        base = rng.choice(names)
+        cut = rng.randint(0, len(base))
+        name = base[:cut] + "".join(rng.choices("aeiouxyzQS", k=rng.randint(0, 4))) + base[cut + rng.randint(0, 3):]
+        if rng.random() < 0.2:
+            name = name.upper()
+        cands = frozenset(rng.sample(names, rng.randint(1, len(names))))
+        assert _best_match.__wrapped__(name or "x", cands) == _ref_best_match(name or "x", cands), (name, cands)
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("productname", "ProductName"),
+        ("QuantitySld", "QuantitySold"),
+        ("SellingPrize", "SellingPrice"),
+        ("Zzz", None),
+    ],
+)
+def test_best_match(name, expected):
+    cands = TABLES["products"] | TABLES["selling"]
+    assert _best_match(name, cands) == expected
+
+
+@pytest.mark.parametrize("reply_fixes", [False, True])
+def test_is_canonical_means_sanitize_is_identity(reply_fixes):
+    seen = 0
+    for s in _canonical_inputs(4, 6000):
+        if is_canonical(s):
+            seen += 1
+            for tables in (TABLES, {}):
+                assert sanitize_sql(s, tables, reply_fixes) == s, s
+    assert seen > 100
+
+
+def test_needs_cleanup_false_means_only_top_is_left():
+    seen = 0
+    for s in _inputs(5, 6000):
+        s = s.strip()
+        if s and not needs_cleanup(s):
+            seen += 1
+            for reply_fixes in (False, True):
+                assert sanitize_sql(s, TABLES, reply_fixes) == inject_top(s), s
+    assert seen > 100
+
+
+@pytest.mark.parametrize(
+    "sql, canonical",
+    [
+        ("SELECT TOP 5 [p].[ProductName] FROM [dbo].[products] AS [p];", True),
+        ("WITH x AS (SELECT 1 AS a) SELECT a FROM x;", True),
+        # no TOP yet: sanitize would add one
+        ("SELECT [p].[ProductName] FROM [dbo].[products] AS [p];", False),
+        ("SELECT TOP 5 a FROM t", False),
+        (" SELECT TOP 5 a FROM t;", False),
+        ("SELECT TOP 5 a FROM Products;", False),
+        ("SELECT TOP 5 p.ProductName FROM [dbo].[products] p;", False),
+        ("SELECT TOP 5 a FROM t WHERE s.Date >= ;", False),
+        ("SELECT TOP 5 a FROM t WHERE x = 1 AND ;", False),
+        ("SELECT TOP 5 `a` FROM t;", False),
+        ("SQL: SELECT TOP 5 a FROM t;", False),
+        ("SELECT TOP 5 a FROM t WHERE d > GETDATE(-7);", False),
+        ("SELECT TOP 5 QuantitySelling FROM t;", False),
+    ],
+)
+def test_is_canonical(sql, canonical):
+    assert is_canonical(sql) is canonical
+    if canonical:
+        assert not needs_cleanup(sql)
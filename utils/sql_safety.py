@@ -1,59 +1,176 @@
 # app/utils/sql_safety.py
 import re
+from functools import lru_cache
 
 # allow only SELECT or CTE
 _START_OK = re.compile(r"^\s*(SELECT|WITH|;WITH)\b", re.IGNORECASE)
 
 # block DDL/DML/EXEC
-_BLOCKED = re.compile(
-    r"\b(INSERT|UPDATE|DELETE|MERGE|ALTER|DROP|TRUNCATE|CREATE|EXEC|EXECUTE|GRANT|REVOKE)\b",
-    re.IGNORECASE,
-)
+_BLOCKED = frozenset({
+    "INSERT", "UPDATE", "DELETE", "MERGE", "ALTER", "DROP", "TRUNCATE",
+    "CREATE", "EXEC", "EXECUTE", "GRANT", "REVOKE",
+})
+
+# one-pass scan: string literals, quoted/[bracketed] identifiers and line comments
+# are skipped whole so keywords inside them ('Drop-in', [Update]) are not flagged.
+# Each opener's closer is found with str.find, so the scan stays linear.
+_SQL_TOKEN = re.compile(r"('|\"|\[|--)|([A-Za-z_]\w*)")
+_CLOSERS = {"'": "'", '"': '"', "[": "]"}
+# T-SQL block comments nest, which a regex cannot follow: when "/*" is present
+# fall back to checking every word in the raw text
+_WORD_TOKEN = re.compile(r"([A-Za-z_]\w*)")
+# a "\r" not followed by "\n": whether it ends a "--" comment depends on the server
+_LONE_CR = re.compile(r"\r(?!\n)")
 
 # markers that the text is explanation, not SQL
 _NONSQL_HINTS = re.compile(
     r"\b(alias|clause|semicolon|note|tip|explanation|warning|advice)\b",
     re.IGNORECASE,
 )
+_NONSQL_HINT_WORDS = frozenset({
+    "alias", "clause", "semicolon", "note", "tip", "explanation", "warning", "advice",
+})
+_WORD_RUN = re.compile(r"\w+")
 
-# SELECT candidates (up to first ;)
-_SELECT_CAND = re.compile(r"(?is)\bSELECT\b[\s\S]*?;")
+# SELECT candidates (up to first ;); [^;]*; is the lazy [\s\S]*?; without the per-char retry
+_SELECT_CAND = re.compile(r"(?is)\bSELECT\b[^;]*;")
 
-# valid CTE head
-_CTE_HEAD = re.compile(r"(?is)^\s*(?:WITH|;WITH)\s+[A-Za-z\[\]_][\w\]\s,]*\s+AS\s*\(", re.IGNORECASE)
+# valid CTE head; .match(text, pos, endpos) at a WITH/;WITH match start, so no ^ or leading \s*
+_CTE_HEAD = re.compile(r"(?is)(?:WITH|;WITH)\s+[A-Za-z\[\]_][\w\]\s,]*\s+AS\s*\(")
 
 # WITH candidates, but only if head matches
-_WITH_CAND = re.compile(r"(?is)\b(?:WITH|;WITH)\b[\s\S]*?;")
+_WITH_CAND = re.compile(r"(?is)\b(?:WITH|;WITH)\b[^;]*;")
 
-# incomplete endings we should trim
+# incomplete endings we should trim; (?<!\s) starts a match only at the head of a
+# whitespace run, since retrying \s+ from every space was quadratic in the run length
 _INCOMPLETE_TAIL = re.compile(
     r"""(?ix)
-    \s+(?:LEFT|RIGHT|FULL|INNER|OUTER)\s*(?:JOIN)?\s*;$
-  | \s+JOIN\s*;$
-  | \s+ON\s*;$
-  | \s+(?:AND|OR)\s*;$
-  | \s+WHERE\s*;$
-  | \s+GROUP\s+BY\s*;$
-  | \s+ORDER\s+BY\s*;$
+    (?<!\s)
+    (?:
+      \s+(?:LEFT|RIGHT|FULL|INNER|OUTER)\s*(?:JOIN)?\s*;$
+    | \s+JOIN\s*;$
+    | \s+ON\s*;$
+    | \s+(?:AND|OR)\s*;$
+    | \s+WHERE\s*;$
+    | \s+GROUP\s+BY\s*;$
+    | \s+ORDER\s+BY\s*;$
+    )
   """
 )
+# longest text enforce_select_only will examine
+_MAX_SQL_CHARS = 64 * 1024
+
+# last word of each _INCOMPLETE_TAIL branch
+_TAIL_KEYWORDS = ("LEFT", "RIGHT", "FULL", "INNER", "OUTER", "JOIN", "ON", "AND", "OR", "WHERE", "BY")
+
+_FENCE_OPEN = re.compile(r"^\s*```(?:sql)?\s*", re.IGNORECASE)
+# (?<!\s): a close fence is matched from the head of the whitespace before it,
+# not retried from every space in the run (quadratic on long runs)
+_FENCE_CLOSE = re.compile(r"(?<!\s)\s*```\s*$")
+# SQLQuery: / SQL: / sql:\n
+_LEADING_LABEL = re.compile(r'^\s*"?(?:SQLQuery|SQL|T-SQL|TSQL)\s*[:\n]\s*', re.IGNORECASE)
+_LEADING_SQL_LINE = re.compile(r"^\s*sql\s*\n\s*", re.IGNORECASE)
+
+# no ';' anywhere: SELECT (or a CTE) through to the end of the text
+_SELECT_TO_END = re.compile(r"(?is)\bSELECT\b[\s\S]*")
+_WITH_TO_END = re.compile(r"(?is)\b(?:WITH|;WITH)\b[\s\S]*")
 
 
 def _strip_code_fences(s: str) -> str:
-    s = re.sub(r"^\s*```(?:sql)?\s*", "", s, flags=re.IGNORECASE)
-    s = re.sub(r"\s*```\s*$", "", s)
+    # both patterns need a literal fence; most replies have none
+    if "```" not in s:
+        return s
+    s = _FENCE_OPEN.sub("", s)
+    s = _FENCE_CLOSE.sub("", s)
     return s
 
 
 def _strip_leading_labels(s: str) -> str:
-    # SQLQuery: / SQL: / sql:\n
-    s = re.sub(r'^\s*"?(?:SQLQuery|SQL|T-SQL|TSQL)\s*[:\n]\s*', "", s, flags=re.IGNORECASE)
-    s = re.sub(r"^\s*sql\s*\n\s*", "", s, flags=re.IGNORECASE)
+    s = _LEADING_LABEL.sub("", s)
+    s = _LEADING_SQL_LINE.sub("", s)
     return s
 
 
+def _skip_quoted(s: str, pos: int, close: str) -> int:
+    """Index just past the literal opened at pos, or -1 if it is never closed."""
+    k = pos + 1
+    while True:
+        j = s.find(close, k)
+        if j < 0:
+            return -1
+        # a doubled closer ('' or ]]) is an escape, not the end
+        if s.startswith(close, j + 1):
+            k = j + 2
+            continue
+        return j + 1
+
+
+def _words_blocked(s: str, tokens: re.Pattern, pos: int = 0) -> bool:
+    return any(m.group(1).upper() in _BLOCKED for m in tokens.finditer(s, pos))
+
+
+def _has_blocked_keyword(s: str) -> bool:
+    # upper() maps char by char, so a blocked token is always a substring of s.upper()
+    up = s.upper()
+    if not any(w in up for w in _BLOCKED):
+        return False
+    if "/*" in s or ("--" in s and _LONE_CR.search(s)):
+        return _words_blocked(s, _WORD_TOKEN)
+    pos = 0
+    while True:
+        m = _SQL_TOKEN.search(s, pos)
+        if m is None:
+            return False
+        opener, word = m.groups()
+        if word:
+            if word.upper() in _BLOCKED:
+                return True
+            pos = m.end()
+        elif opener == "--":
+            end = s.find("\n", m.end())
+            if end < 0:
+                return False
+            pos = end + 1
+        else:
+            end = _skip_quoted(s, m.start(), _CLOSERS[opener])
+            if end < 0:
+                # unterminated: check every word after the opener
+                return _words_blocked(s, _WORD_TOKEN, m.end())
+            pos = end
+
+
+def _has_nonsql_hint(s: str) -> bool:
+    if not s.isascii():
+        # non-ASCII letters can case-fold onto ASCII (and change \w); let the regex decide
+        return _NONSQL_HINTS.search(s) is not None
+    # a \b...\b hit is exactly a whole \w run equal to a hint word
+    return not _NONSQL_HINT_WORDS.isdisjoint(_WORD_RUN.findall(s.lower()))
+
+
+def _may_contain_sql(s: str) -> bool:
+    # _pick_best_sql needs a SELECT or WITH keyword; non-ASCII text may case-fold onto one
+    if not s.isascii():
+        return True
+    low = s.lower()
+    return "select" in low or "with" in low
+
+
+def _may_have_incomplete_tail(c: str) -> bool:
+    # every _INCOMPLETE_TAIL branch is "<keyword>\s*;" at the end ($ also allows one "\n" after)
+    if c.endswith("\n"):
+        c = c[:-1]
+    if not c.endswith(";"):
+        return False
+    tail = c[:-1].rstrip()[-5:]
+    # non-ASCII letters can case-fold onto the keywords; let the regex decide
+    return not tail.isascii() or tail.upper().endswith(_TAIL_KEYWORDS)
+
+
 def _trim_incomplete_tail(c: str) -> str:
-    return _INCOMPLETE_TAIL.sub(";", c.rstrip())
+    c = c.rstrip()
+    if not _may_have_incomplete_tail(c):
+        return c
+    return _INCOMPLETE_TAIL.sub(";", c)
 
 
 def _score_candidate(c: str) -> int:
@@ -67,25 +184,26 @@ def _score_candidate(c: str) -> int:
         score += 10
     if len(c) >= 40:
         score += min(len(c) // 50, 20)
-    if _NONSQL_HINTS.search(c):
+    if _has_nonsql_hint(c):
         score -= 100
     # unclosed quote
     if c.count("'") % 2 == 1:
         score -= 40
     # incomplete tail
-    if _INCOMPLETE_TAIL.search(c):
+    if _may_have_incomplete_tail(c) and _INCOMPLETE_TAIL.search(c):
         score -= 20
     return score
 
 
 def _collect_candidates(text: str) -> list[str]:
+    # every candidate ends at a ';': past the last one, each SELECT would rescan to the end
+    text = text[: text.rfind(";") + 1]
     cands = [m.group(0).strip() for m in _SELECT_CAND.finditer(text)]
     # also try WITH if the head looks valid
     for m in _WITH_CAND.finditer(text):
-        seg = m.group(0).strip()
-        head = seg[:140]
-        if _CTE_HEAD.search(head):
-            cands.append(seg)
+        # head test on the first 140 chars of the match, read in place
+        if _CTE_HEAD.match(text, m.start(), min(m.start() + 140, m.end())):
+            cands.append(m.group(0).strip())
     return cands
 
 
@@ -93,44 +211,51 @@ def _pick_best_sql(text: str) -> str | None:
     cands = _collect_candidates(text)
     if not cands:
         # no semicolon → try SELECT to end
-        m_sel = re.search(r"(?is)\bSELECT\b[\s\S]*", text)
+        m_sel = _SELECT_TO_END.search(text)
         if m_sel:
             s = m_sel.group(0).strip()
             if not s.endswith(";"):
                 s += ";"
             return _trim_incomplete_tail(s)
         # try CTE to end if head is valid
-        m_w = re.search(r"(?is)\b(?:WITH|;WITH)\b[\s\S]*", text)
-        if m_w and _CTE_HEAD.search(text[m_w.start(): m_w.start() + 160]):
+        m_w = _WITH_TO_END.search(text)
+        if m_w and _CTE_HEAD.match(text, m_w.start(), m_w.start() + 160):
             s = text[m_w.start():].strip()
             if not s.endswith(";"):
                 s += ";"
             return _trim_incomplete_tail(s)
         return None
-    best = max(cands, key=_score_candidate)
+    # a lone candidate wins without being scored
+    best = cands[0] if len(cands) == 1 else max(cands, key=_score_candidate)
     return _trim_incomplete_tail(best)
 
 
+@lru_cache(maxsize=256)
 def enforce_select_only(sql_text: str) -> str:
     """
     Extract the best valid SELECT/CTE and block DML/DDL.
+    Pure in its input, so results are memoized (rejections raise and are not cached).
     """
-    if not sql_text or not str(sql_text).strip():
+    # one conversion and one strip (str() of a str is a no-op, but strip() copies)
+    s = (sql_text if isinstance(sql_text, str) else str(sql_text or "")).strip()
+    if not s:
         raise ValueError("Empty SQL. Please provide a valid SELECT/CTE.")
+    if len(s) > _MAX_SQL_CHARS:
+        # bounds the work below; model replies are a few hundred chars
+        raise ValueError(f"SQL too long (over {_MAX_SQL_CHARS} characters).")
 
-    s = str(sql_text).strip()
     s = _strip_code_fences(s)
     s = _strip_leading_labels(s)
 
-    if not _START_OK.match(s) or _NONSQL_HINTS.search(s):
-        chosen = _pick_best_sql(s)
+    if not _START_OK.match(s) or _has_nonsql_hint(s):
+        chosen = _pick_best_sql(s) if _may_contain_sql(s) else None
         if not chosen:
             raise ValueError("Could not extract a valid SELECT/CTE from LLM response.")
         s = chosen
     else:
         s = _pick_best_sql(s) or s
 
-    if _BLOCKED.search(s):
+    if _has_blocked_keyword(s):
         raise ValueError("Only SELECT/CTE is allowed. DML/DDL/EXEC found.")
 
     if not s.rstrip().endswith(";"):